@@ -1,6 +1,5 @@
 from flask import Flask, request, current_app
 from config import Config
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
@@ -8,13 +7,15 @@ from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel
 from elasticsearch import Elasticsearch
+from app.search import IndexingQueue, SearchResultCache, create_backend
+from app import replicas
+import atexit
 import logging
-from logging.handlers import SMTPHandler, RotatingFileHandler
-import os
 
 # First initialization (global)
 bootstrap = Bootstrap()
-db = SQLAlchemy()
+# Routes GET request reads to read replicas when SQLALCHEMY_REPLICAS is set
+db = replicas.RoutingSQLAlchemy()
 login = LoginManager()
 login.login_view = 'auth.login'
 migrate = Migrate()
@@ -29,6 +30,7 @@ def create_app(config_class=Config):
 
     # Binding extension instances to main application
     db.init_app(app)
+    replicas.init_app(app)
     migrate.init_app(app, db)
     login.init_app(app)
     mail.init_app(app)
@@ -36,8 +38,75 @@ def create_app(config_class=Config):
     moment.init_app(app)
     babel.init_app(app)
 
+    # Optional shared cache backend for multi-process deployments
+    if app.config.get('REDIS_URL'):
+        from redis import Redis
+        app.redis = Redis.from_url(app.config['REDIS_URL'])
+    else:
+        app.redis = None
+
     app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
         if app.config['ELASTICSEARCH_URL'] else None
+    app.search_backend = create_backend(app)
+    # Index changes are sent in background bulk requests, drained at exit
+    app.search_queue = IndexingQueue(app, app.search_backend) \
+        if app.search_backend else None
+    if app.search_queue:
+        atexit.register(app.search_queue.close, timeout=30)
+    app.search_cache = SearchResultCache(app)
+
+    # last_seen updates are buffered and written in bulk, drained at exit
+    from app.last_seen import LastSeenBuffer
+    app.last_seen = LastSeenBuffer(app)
+    atexit.register(app.last_seen.flush)
+
+    # Trending terms over recent posts, snapshotted to disk at exit; without
+    # Redis rebuilt from the posts table once the app serves requests
+    from app.trending import Trending
+    app.trending = Trending(app)
+    atexit.register(app.trending.close)
+    app.before_first_request(app.trending.start)
+
+    # Follow graph kept in memory for graph queries; no page needs it yet
+    # (the suggestions job loads its own copy), so web processes only load
+    # it, in the background on their first request, with FOLLOW_GRAPH_PRELOAD
+    from app.graph import FollowGraph
+    app.follow_graph = FollowGraph(app)
+    if app.config.get('FOLLOW_GRAPH_PRELOAD', False):
+        app.before_first_request(app.follow_graph.start)
+
+    # Logged in users are loaded from a cache instead of once per request
+    from app.user_cache import UserCache
+    app.user_cache = UserCache(app)
+
+    # Rendered _post.html fragments, invalidated per post
+    from app.fragments import FragmentCache, render_post
+    app.fragment_cache = FragmentCache(app)
+    app.jinja_env.globals['render_post'] = render_post
+
+    # Newest posts kept in memory for the first pages of explore, loaded
+    # once the app serves requests (the schema may not exist before)
+    from app.recent import RecentPosts
+    app.recent_posts = RecentPosts(app)
+    app.before_first_request(app.recent_posts.preload)
+
+    # New posts are pushed to followers' open /stream connections
+    from app.stream import PostBus
+    app.post_bus = PostBus(app)
+
+    # Outbound mail goes through a bounded queue and pooled SMTP connections
+    from app.email import MailQueue
+    app.mail_queue = MailQueue(app)
+    atexit.register(app.mail_queue.close, timeout=30)
+
+    # New posts get their language detected off the request path
+    from app.posts import LanguageDetector
+    app.language_detector = LanguageDetector(app)
+    atexit.register(app.language_detector.close)
+
+    # Per-request SQL/template/search timings, Server-Timing and /metrics
+    from app import instrumentation
+    instrumentation.init_app(app)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -48,33 +117,13 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
-    # Only enable email error logger if not in debug mode
-    # Server must be configured in config.py
+    # Logs go through a queue to a JSON log file rotated daily and by size,
+    # and errors are mailed to the admins as rate-limited digests, so logging
+    # never blocks a request on disk or SMTP
     if not app.debug and not app.testing:
-        if current_app.config['MAIL_SERVER']:
-            auth = None
-            if current_app.config['MAIL_USERNAME'] or current_app.config['MAIL_PASSWORD']:
-                auth = (current_app.config['MAIL_USERNAME'], current_app.config['MAIL_PASSWORD'])
-            secure = None
-            if current_app.config['MAIL_USE_TLS']:
-                secure = ()
-            mail_handler = SMTPHandler(
-                mailhost=(current_app.config['MAIL_SERVER'], current_app.config['MAIL_PORT']),
-                fromaddr='no-reply@' + current_app.config['MAIL_SERVER'],
-                toaddrs=current_app.config['ADMINS'], subject='Microblog Failure',
-                credentials=auth, secure=secure, timeout=10)
-            mail_handler.setLevel(logging.ERROR)
-            app.logger.addHandler(mail_handler)
-        # Rotating error log
-        if not os.path.exists('logs'):
-            os.mkdir('logs')
-        file_handler = RotatingFileHandler('logs/microblog.log', maxBytes=10240,
-            backupCount=10)
-        file_handler.setFormatter(logging.Formatter(
-            '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-        file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler)
-
+        from app.logs import LogPipeline
+        app.log_pipeline = LogPipeline(app)
+        atexit.register(app.log_pipeline.close)
         app.logger.setLevel(logging.INFO)
         app.logger.info('Microblog startup')
 
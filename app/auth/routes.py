@@ -1,6 +1,4 @@
-from datetime import datetime
-
-from flask import flash, g, redirect, render_template, request, url_for
+from flask import current_app, flash, g, redirect, render_template, request, url_for
 from flask_login import current_user, login_required, login_user, logout_user
 from flask_babel import _, get_locale
 from guess_language import guess_language
@@ -100,6 +98,5 @@ def reset_password(token):
 @bp.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        current_app.last_seen.touch(current_user.id)
     g.locale = str(get_locale())
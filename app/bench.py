@@ -0,0 +1,274 @@
+import bisect
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+
+from flask import current_app
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from app import db
+from app.graph import Adjacency, intersect
+from app.models import Post, User, bump_content_version, followers, \
+    recompute_counters
+from app.transfer import reindex_posts, reset_sequences
+
+WORDS = ('time person year way day thing man world life hand part child eye '
+         'woman place work week case point government company number group '
+         'problem fact good new first last long great little own other old '
+         'right big high different small large next early young important '
+         'few public bad same able python flask coffee music travel weekend '
+         'game movie book code data cloud night morning city river').split()
+
+ROUTES = ('index', 'explore', 'user', 'follow', 'search')
+
+
+# Keeps per-request access logs out of the benchmark output
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+# Cumulative Zipf weights over n ranks, for O(log n) power-law sampling
+def zipf_cum_weights(n, alpha):
+    total, cum_weights = 0.0, []
+    for rank in range(1, n + 1):
+        total += 1.0 / rank ** alpha
+        cum_weights.append(total)
+    return cum_weights
+
+
+def zipf_sample(rng, cum_weights):
+    return bisect.bisect_left(cum_weights, rng.random() * cum_weights[-1])
+
+
+def _insert_batches(table, rows, batch_size):
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return
+        with db.engine.begin() as conn:
+            conn.execute(table.insert(), batch)
+
+
+# Bulk-generates users, follow edges and posts with Core executemany batches
+# Follow targets and post authors are drawn from Zipf distributions, so a few
+# accounts are followed by (and post) far more than the rest; per-user
+# out-degree is Pareto distributed around follows_per_user
+# Like import_data, the session hooks are bypassed, so afterwards sequences
+# are moved past the seeded ids, caches cleared and the posts reindexed
+def seed_data(users, posts, follows_per_user, batch_size=10000, alpha=1.1,
+              days=30, random_seed=None):
+    rng = random.Random(random_seed)
+    first_id = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    first_post_id = (db.session.query(db.func.max(Post.id)).scalar() or 0) + 1
+    db.session.commit()
+    ids = range(first_id, first_id + users)
+    password_hash = generate_password_hash('bench')
+    now = datetime.utcnow()
+    _insert_batches(User.__table__, ({
+        'id': id, 'username': 'bench{}'.format(id),
+        'email': 'bench{}@example.com'.format(id),
+        'password_hash': password_hash, 'last_seen': now,
+        'followers_count': 0, 'followed_count': 0, 'posts_count': 0,
+        'revision': 0} for id in ids), batch_size)
+
+    # Popularity ranks are shuffled so popular accounts aren't the lowest ids
+    popular = list(ids)
+    rng.shuffle(popular)
+    cum_weights = zipf_cum_weights(users, alpha)
+
+    def edges():
+        for follower in ids:
+            degree = min(users - 1, int(rng.paretovariate(2.0) *
+                                        follows_per_user / 2.0))
+            targets = set()
+            for _ in range(degree * 2):
+                if len(targets) >= degree:
+                    break
+                followed = popular[zipf_sample(rng, cum_weights)]
+                if followed != follower:
+                    targets.add(followed)
+            for followed in targets:
+                yield {'follower_id': follower, 'followed_id': followed}
+    _insert_batches(followers, edges(), batch_size)
+
+    span = timedelta(days=days).total_seconds()
+    _insert_batches(Post.__table__, ({
+        'body': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 20))),
+        'user_id': popular[zipf_sample(rng, cum_weights)],
+        'timestamp': now - timedelta(seconds=rng.random() * span),
+        'language': 'en'} for _ in range(posts)), batch_size)
+
+    with db.engine.begin() as conn:
+        reset_sequences(conn)
+    recompute_counters()
+    # Seeded posts can be older than the newest one, so caches keyed on it
+    # need the content version to notice them
+    bump_content_version(db.session)
+    db.session.commit()
+    current_app.follow_graph.clear()
+    current_app.recent_posts.clear()
+    current_app.search_cache.clear()
+    last_post_id = db.session.query(db.func.max(Post.id)).scalar() or 0
+    db.session.commit()
+    reindex_posts(first_post_id, last_post_id, batch_size)
+
+
+# Builds follow graph arrays for a synthetic graph (Zipf popularity, like
+# seed_data) in memory, without a database, and reports build time, memory
+# and query latencies (microseconds)
+def graph_benchmark(users=1000000, edges=10000000, alpha=1.1, queries=10000,
+                    random_seed=None):
+    rng = random.Random(random_seed)
+    popular = list(range(1, users + 1))
+    rng.shuffle(popular)
+    cum_weights = zipf_cum_weights(users, alpha)
+    per_user = edges // users
+
+    def pairs():
+        remaining = edges
+        for follower in range(1, users + 1):
+            degree = min(remaining, per_user if follower < users else remaining)
+            remaining -= degree
+            targets = set()
+            while len(targets) < degree:
+                followed = popular[zipf_sample(rng, cum_weights)]
+                if followed != follower:
+                    targets.add(followed)
+            for followed in sorted(targets):
+                yield follower, followed
+
+    start = time.perf_counter()
+    followed = Adjacency.from_sorted_pairs(pairs())
+    generated = time.perf_counter() - start
+    start = time.perf_counter()
+    followers = followed.transposed()
+    transposed = time.perf_counter() - start
+
+    def timed(query):
+        samples = []
+        for _ in range(queries):
+            a, b = rng.randint(1, users), popular[zipf_sample(rng, cum_weights)]
+            start = time.perf_counter()
+            query(a, b)
+            samples.append((time.perf_counter() - start) * 1e6)
+        samples.sort()
+        return {'p50': round(percentile(samples, 0.50), 1),
+                'p99': round(percentile(samples, 0.99), 1)}
+
+    return {
+        'users': users, 'edges': len(followed.targets),
+        'bytes': followed.memory_usage() + followers.memory_usage(),
+        'bytes_per_edge': round((followed.memory_usage() +
+                                 followers.memory_usage()) / len(followed.targets), 2),
+        'build_seconds': round(generated, 1),
+        'transpose_seconds': round(transposed, 1),
+        'is_following': timed(lambda a, b: followed.contains(a, b)),
+        'followers_count': timed(lambda a, b: followers.degree(b)),
+        'followed_followers': timed(
+            lambda a, b: intersect(followed.neighbors(a), followers.neighbors(b))),
+    }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1,
+                max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+# Drives the app concurrently with a mix of route requests, either through
+# the Flask test client or a local threaded WSGI server, and returns
+# throughput and latency percentiles (milliseconds) per route
+def run_benchmark(app, routes=ROUTES, requests=1000, concurrency=8,
+                  server=False, random_seed=None):
+    rng = random.Random(random_seed)
+    usernames = [row[0] for row in db.session.query(User.username).filter(
+        User.username.like('bench%')).limit(10000)]
+    if not usernames:
+        raise RuntimeError('No bench users found, run `flask bench seed` first')
+    user_ids = {row[0]: row[1] for row in db.session.query(
+        User.username, User.id).filter(User.username.in_(usernames[:1000]))}
+    db.session.commit()
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    plan = []
+    for _ in range(requests):
+        route = rng.choice(routes)
+        target = rng.choice(usernames)
+        if route == 'index':
+            plan.append((route, 'GET', '/index'))
+        elif route == 'explore':
+            plan.append((route, 'GET', '/explore'))
+        elif route == 'user':
+            plan.append((route, 'GET', '/user/' + target))
+        elif route == 'follow':
+            plan.append((route, 'POST', '/follow/' + target))
+        elif route == 'search':
+            plan.append((route, 'GET', '/search?q=' + rng.choice(WORDS)))
+    chunks = [plan[i::concurrency] for i in range(concurrency)]
+
+    httpd = None
+    if server:
+        httpd = make_server('127.0.0.1', 0, app, threaded=True,
+                            request_handler=QuietRequestHandler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        base_url = 'http://127.0.0.1:{}'.format(httpd.server_port)
+
+    logins = [rng.choice(list(user_ids.values())) for _ in chunks]
+
+    def worker(chunk, user_id):
+        # Each worker is logged in as a random bench user
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+        cookie = 'session=' + next(c.value for c in client.cookie_jar
+                                   if c.name == 'session')
+        results = []
+        for route, method, path in chunk:
+            start = time.perf_counter()
+            if server:
+                try:
+                    with urlopen(Request(base_url + path, method=method,
+                                         data=b'' if method == 'POST' else None,
+                                         headers={'Cookie': cookie})) as response:
+                        response.read()
+                        status = response.status
+                except HTTPError as e:
+                    status = e.code
+            else:
+                status = client.open(path, method=method).status_code
+            results.append((route, status, time.perf_counter() - start))
+        return results
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(itertools.chain.from_iterable(
+            pool.map(worker, chunks, logins)))
+    elapsed = time.perf_counter() - start
+    if httpd is not None:
+        httpd.shutdown()
+
+    report = {'requests': len(results), 'concurrency': concurrency,
+              'seconds': round(elapsed, 3),
+              'throughput': round(len(results) / elapsed, 1), 'routes': {}}
+    for route in routes:
+        latencies = sorted(r[2] * 1000 for r in results if r[0] == route)
+        if not latencies:
+            continue
+        errors = sum(1 for r in results if r[0] == route and r[1] >= 400)
+        report['routes'][route] = {
+            'count': len(latencies), 'errors': errors,
+            'throughput': round(len(latencies) / elapsed, 1),
+            'p50': round(percentile(latencies, 0.50), 2),
+            'p95': round(percentile(latencies, 0.95), 2),
+            'p99': round(percentile(latencies, 0.99), 2)}
+    return report
@@ -1,6 +1,15 @@
+from concurrent.futures import ProcessPoolExecutor
 import click
+import json
 import os
 
+from app import db
+from app.bench import ROUTES, graph_benchmark, run_benchmark, seed_data
+from app.models import recompute_counters
+from app.posts import backfill_languages
+from app.suggestions import compute_suggestions
+from app.transfer import FORMATS, export_data, import_data
+
 # Can't use current_app because below commands are registered at startup
 # while current_app is only available while a request is being handled
 # register(app) is called in microblog.py after app is created
@@ -38,3 +47,122 @@ def register(app):
                 'pybabel init -i messages.pot -d app/translations -l ' + lang):
             raise RuntimeError('init command failed')
         os.remove('messages.pot')
+
+    # Denormalized counters
+    @app.cli.group()
+    def counters():
+        """Denormalized counter maintenance commands."""
+        pass
+
+    @counters.command()
+    def recompute():
+        """Recompute follower, following and post counts for every user."""
+        recompute_counters()
+        db.session.commit()
+
+    # Posts
+    @app.cli.group()
+    def posts():
+        """Post maintenance commands."""
+        pass
+
+    @posts.command('detect-languages')
+    @click.option('--batch-size', default=1000, help='Posts per batch.')
+    @click.option('--workers', default=os.cpu_count(), help='Worker processes.')
+    def detect_languages(batch_size, workers):
+        """Detect languages for posts that have none."""
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            updated = backfill_languages(pool, batch_size)
+        click.echo('Detected languages for {} posts'.format(updated))
+
+    # Bulk data transfer
+    @app.cli.group()
+    def data():
+        """Bulk import and export commands."""
+        pass
+
+    @data.command('export')
+    @click.argument('directory', type=click.Path(file_okay=False))
+    @click.option('--format', 'fmt', type=click.Choice(FORMATS),
+                  default='ndjson', help='File format.')
+    @click.option('--chunk-size', default=10000, help='Rows fetched at a time.')
+    def export_(directory, fmt, chunk_size):
+        """Export users, follow edges and posts to a directory."""
+        counts = export_data(directory, fmt, chunk_size)
+        click.echo('Exported ' + ', '.join(
+            '{} {} rows'.format(count, table) for table, count in counts.items()))
+
+    @data.command('import')
+    @click.argument('directory', type=click.Path(exists=True, file_okay=False))
+    @click.option('--format', 'fmt', type=click.Choice(FORMATS),
+                  default='ndjson', help='File format.')
+    @click.option('--chunk-size', default=10000, help='Rows per INSERT batch.')
+    def import_(directory, fmt, chunk_size):
+        """Import users, follow edges and posts exported by `data export`."""
+        counts = import_data(directory, fmt, chunk_size)
+        click.echo('Imported ' + ', '.join(
+            '{} {} rows'.format(count, table) for table, count in counts.items()))
+
+    # Who to follow
+    @app.cli.group()
+    def suggestions():
+        """Follow suggestion commands."""
+        pass
+
+    @suggestions.command()
+    @click.option('--top-k', default=10, help='Suggestions kept per user.')
+    @click.option('--chunk-size', default=1000, help='User ids per task.')
+    @click.option('--max-degree', default=1000,
+                  help='Accounts with more followers are left out of co-follow.')
+    @click.option('--workers', default=os.cpu_count(), help='Worker processes.')
+    def compute(top_k, chunk_size, max_degree, workers):
+        """Recompute who-to-follow suggestions for every user."""
+        written = compute_suggestions(app, workers=workers, chunk_size=chunk_size,
+                                      top_k=top_k, max_degree=max_degree)
+        click.echo('Stored {} suggestions'.format(written))
+
+    # Load generation and benchmarking
+    @app.cli.group()
+    def bench():
+        """Synthetic data and load-test commands."""
+        pass
+
+    @bench.command()
+    @click.option('--users', default=10000, help='Users to create.')
+    @click.option('--posts', default=100000, help='Posts to create.')
+    @click.option('--follows', default=50, help='Mean follows per user.')
+    @click.option('--batch-size', default=10000, help='Rows per INSERT batch.')
+    @click.option('--alpha', default=1.1, help='Zipf exponent for popularity.')
+    @click.option('--seed', 'random_seed', type=int, help='Random seed.')
+    def seed(users, posts, follows, batch_size, alpha, random_seed):
+        """Bulk-generate users, follow edges and posts."""
+        seed_data(users, posts, follows, batch_size=batch_size, alpha=alpha,
+                  random_seed=random_seed)
+        click.echo('Seeded {} users and {} posts'.format(users, posts))
+
+    @bench.command()
+    @click.option('--routes', default=','.join(ROUTES),
+                  help='Comma-separated routes to exercise.')
+    @click.option('--requests', default=1000, help='Total requests.')
+    @click.option('--concurrency', default=8, help='Concurrent clients.')
+    @click.option('--server', is_flag=True,
+                  help='Drive a local WSGI server instead of the test client.')
+    @click.option('--output', type=click.File('w'), default='-',
+                  help='Where to write the JSON report.')
+    def run(routes, requests, concurrency, server, output):
+        """Run a concurrent load test and report latency per route."""
+        report = run_benchmark(app, routes=routes.split(','), requests=requests,
+                               concurrency=concurrency, server=server)
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.write('\n')
+
+    @bench.command()
+    @click.option('--users', default=1000000, help='Users in the graph.')
+    @click.option('--edges', default=10000000, help='Follow edges.')
+    @click.option('--alpha', default=1.1, help='Zipf exponent for popularity.')
+    @click.option('--seed', 'random_seed', type=int, help='Random seed.')
+    def graph(users, edges, alpha, random_seed):
+        """Measure follow graph memory and query times on a synthetic graph."""
+        report = graph_benchmark(users, edges, alpha=alpha,
+                                 random_seed=random_seed)
+        click.echo(json.dumps(report, indent=2, sort_keys=True))
@@ -0,0 +1,55 @@
+import time
+from hashlib import md5
+
+from flask import current_app, g, make_response, request, session
+from flask_login import current_user
+
+
+# ETag/Last-Modified validators for pages fully determined by a few cheap
+# values (e.g. the key of the newest post in scope and the profile shown)
+# Views build them before any heavy query, return response() right away if
+# not_modified(), and otherwise pass the rendered page to response()
+# The viewer, their revision and the locale are always part of the ETag
+class PageValidators(object):
+    def __init__(self, last_modified, *parts):
+        viewer = (current_user.id, current_user.revision) \
+            if current_user.is_authenticated else None
+        self.etag = md5(repr(parts + (viewer, g.get('locale'),
+                                      _csrf_epoch())).encode('utf-8')).hexdigest()
+        # HTTP dates have no sub-second precision
+        self.last_modified = last_modified.replace(microsecond=0) \
+            if last_modified else None
+
+    def not_modified(self):
+        if request.method not in ('GET', 'HEAD'):
+            return False
+        # Flashed messages are consumed by the render, so it can't be skipped
+        if '_flashes' in session:
+            return False
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(self.etag)
+        # Only the newest post is dated, so a bare If-Modified-Since misses
+        # profile changes; browsers send If-None-Match as well
+        if request.if_modified_since and self.last_modified:
+            return self.last_modified <= request.if_modified_since
+        return False
+
+    def response(self, body=None):
+        response = make_response(('', 304) if body is None else body)
+        response.set_etag(self.etag)
+        if self.last_modified:
+            response.last_modified = self.last_modified
+        # Pages are per viewer, and must be revalidated on every use
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+
+# Pages embed CSRF tokens, so the ETag rolls over every half of the token
+# lifetime to keep a 304'd page's forms submittable
+def _csrf_epoch():
+    config = current_app.config
+    limit = config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    if not config.get('WTF_CSRF_ENABLED', True) or not limit:
+        return None
+    return int(time.time() // (limit / 2))
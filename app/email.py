@@ -1,26 +1,102 @@
+import queue
+import threading
+
 from flask import current_app, render_template
 from flask_mail import Message
-from threading import Thread
 from app import mail
 
 
-def send_async_email(app, msg):
-    # app_context() gives access to application instance
-    # b/c need to access config
-    with app.app_context():
-        mail.send(msg)
+# Bounded outbound mail queue drained by a fixed pool of worker threads
+# Each worker keeps its SMTP connection open while there is mail to send and
+# closes it after MAIL_IDLE_TIMEOUT seconds without work, so a burst of
+# messages shares a handful of connections instead of one thread and one
+# handshake per message
+# Workers need the real application instance (NOT the current_app proxy)
+# to push an app context, since they run outside of any request
+class MailQueue(object):
+    def __init__(self, app):
+        self.app = app
+        self.num_workers = app.config.get('MAIL_WORKERS', 2)
+        self.idle_timeout = app.config.get('MAIL_IDLE_TIMEOUT', 30)
+        self.put_timeout = app.config.get('MAIL_QUEUE_TIMEOUT', 5)
+        self._queue = queue.Queue(maxsize=app.config.get('MAIL_QUEUE_SIZE', 1000))
+        self._workers = []
+        self._lock = threading.Lock()
+
+    # Blocks while the queue is full (backpressure), up to MAIL_QUEUE_TIMEOUT
+    # Returns False if the message had to be dropped
+    def put(self, msg):
+        self._start()
+        try:
+            self._queue.put(msg, timeout=self.put_timeout)
+        except queue.Full:
+            self.app.logger.error('Mail queue full, dropping message %r',
+                                  msg.subject)
+            return False
+        return True
+
+    def _start(self):
+        with self._lock:
+            if self._workers:
+                return
+            for _ in range(self.num_workers):
+                worker = threading.Thread(target=self._run, daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    # Sends everything already queued, then stops the workers
+    def close(self, timeout=None):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for _ in workers:
+            self._queue.put(None)
+        for worker in workers:
+            worker.join(timeout)
+
+    def _run(self):
+        with self.app.app_context():
+            conn = None
+            while True:
+                try:
+                    msg = self._queue.get(
+                        timeout=self.idle_timeout if conn else None)
+                except queue.Empty:
+                    conn = self._disconnect(conn)
+                    continue
+                try:
+                    if msg is None:
+                        self._disconnect(conn)
+                        return
+                    conn = self._send(conn, msg)
+                finally:
+                    self._queue.task_done()
+
+    # Sends on the open connection, reconnecting once if it has gone stale
+    def _send(self, conn, msg):
+        for attempt in range(2):
+            try:
+                if conn is None:
+                    conn = mail.connect().__enter__()
+                conn.send(msg)
+                return conn
+            except Exception as e:
+                conn = self._disconnect(conn)
+                if attempt:
+                    self.app.logger.error('Failed to send mail %r: %s',
+                                          msg.subject, e)
+        return conn
+
+    def _disconnect(self, conn):
+        if conn is not None:
+            try:
+                conn.__exit__(None, None, None)
+            except Exception:
+                pass
+        return None
 
 
-# current_app is context-dependent and tied to the thread running the client request
-# Background thread wouldn't have value assigned to current_app, so can't pass directly
-# to send_async_email
-# Can't directly pass to Thread either since current_app is dynamically mapped
-# to application instance
-# Need to access real application instance (NOT proxy) using _get_current_object
-# and pass to thread as argument
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email,
-           args=(current_app._get_current_object(), msg)).start()
+    current_app.mail_queue.put(msg)
@@ -0,0 +1,138 @@
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from flask import current_app, g, render_template
+from markupsafe import Markup
+
+
+# Cache of rendered _post.html fragments keyed by (post id, locale, author
+# revision, language), held in a bounded in-process LRU and optionally
+# shared through Redis when REDIS_URL is configured
+# Username/email changes bump the author's revision and detected languages
+# change the key, so their old fragments simply stop being hit in every
+# process; post changes invalidate explicitly, in every process when Redis
+# is configured (through a pub/sub channel)
+# Local entries expire after FRAGMENT_CACHE_LOCAL_TTL seconds, which bounds
+# how long a process without Redis serves a fragment invalidated elsewhere
+class FragmentCache(object):
+    channel = 'fragment:invalidate'
+
+    def __init__(self, app):
+        self.app = app
+        self.max_size = app.config.get('FRAGMENT_CACHE_SIZE', 10000)
+        self.ttl = app.config.get('FRAGMENT_CACHE_TTL', 3600)
+        self.local_ttl = app.config.get('FRAGMENT_CACHE_LOCAL_TTL', 60)
+        self.redis = app.redis
+        self._source = uuid.uuid4().hex
+        # key -> (expiry time, post id, html)
+        self._lru = OrderedDict()
+        self._keys_by_post = {}
+        self._lock = threading.Lock()
+        self._listener = None
+
+    @staticmethod
+    def key(post_id, locale, revision, language):
+        return 'fragment:post:{}:{}:{}:{}'.format(post_id, locale, revision,
+                                                  language or '')
+
+    def get(self, key, post_id):
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._lru.move_to_end(key)
+                    return entry[2]
+                self._drop(key)
+        if self.redis is not None:
+            html = self.redis.get(key)
+            if html is not None:
+                html = html.decode('utf-8')
+                self._store(key, post_id, html)
+                return html
+        return None
+
+    def set(self, key, post_id, html):
+        self._store(key, post_id, html)
+        if self.redis is not None:
+            pipe = self.redis.pipeline()
+            pipe.set(key, html, ex=self.ttl)
+            pipe.sadd('fragment:post:{}'.format(post_id), key)
+            pipe.expire('fragment:post:{}'.format(post_id), self.ttl)
+            pipe.execute()
+
+    def _store(self, key, post_id, html):
+        with self._lock:
+            if self.redis is not None and self._listener is None:
+                self._listener = threading.Thread(target=self._listen,
+                                                  daemon=True)
+                self._listener.start()
+            self._drop(key)
+            self._lru[key] = (time.time() + self.local_ttl, post_id, html)
+            self._keys_by_post.setdefault(post_id, set()).add(key)
+            while len(self._lru) > self.max_size:
+                self._drop(next(iter(self._lru)))
+
+    # Removes an entry and its place in the per-post index (caller holds
+    # the lock)
+    def _drop(self, key):
+        entry = self._lru.pop(key, None)
+        if entry is None:
+            return
+        keys = self._keys_by_post.get(entry[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_post[entry[1]]
+
+    def invalidate_post(self, post_id):
+        self._invalidate_local(post_id)
+        if self.redis is not None:
+            index = 'fragment:post:{}'.format(post_id)
+            keys = self.redis.smembers(index)
+            self.redis.delete(index, *keys)
+            self.redis.publish(self.channel, json.dumps(
+                {'source': self._source, 'post_id': post_id}))
+
+    def _invalidate_local(self, post_id):
+        with self._lock:
+            for key in list(self._keys_by_post.get(post_id, ())):
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+            self._keys_by_post.clear()
+
+    def _listen(self):
+        subscribed = False
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # Invalidations published while unsubscribed were missed
+                if subscribed:
+                    self.clear()
+                subscribed = True
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    data = json.loads(message['data'])
+                    if data['source'] != self._source:
+                        self._invalidate_local(data['post_id'])
+            except Exception:
+                self.app.logger.exception('Fragment invalidation listener failed')
+                time.sleep(1)
+
+
+# Jinja global used by the feed templates in place of including _post.html
+def render_post(post):
+    cache = current_app.fragment_cache
+    key = cache.key(post.id, g.locale, post.author.revision or 0, post.language)
+    html = cache.get(key, post.id)
+    if html is None:
+        html = render_template('_post.html', post=post)
+        cache.set(key, post.id, html)
+    return Markup(html)
@@ -0,0 +1,369 @@
+import bisect
+import json
+import sys
+import threading
+import time
+import uuid
+from array import array
+
+from app import db
+from app.models import followers
+
+# User ids are 32-bit, offsets into the edge arrays 64-bit
+ID_TYPE = 'i'
+OFFSET_TYPE = 'q'
+
+
+def _zeros(typecode, n):
+    return array(typecode, bytes(array(typecode).itemsize * n))
+
+
+# Compressed sparse row adjacency with user ids as vertices: the neighbors
+# of v are targets[offsets[v]:offsets[v + 1]], in ascending order
+# The arrays are never modified once built; edges changed since then live
+# in per-vertex added/removed sets (added never overlaps the arrays, removed
+# is a subset of them) until compacted() folds them in
+class Adjacency(object):
+    def __init__(self, offsets, targets):
+        self.offsets = offsets
+        self.targets = targets
+        self.added = {}
+        self.removed = {}
+        self.pending = 0
+
+    # pairs: (source, target) sorted by source, then target
+    @classmethod
+    def from_sorted_pairs(cls, pairs):
+        counts, targets = _zeros(OFFSET_TYPE, 1), array(ID_TYPE)
+        for source, target in pairs:
+            if source + 1 >= len(counts):
+                counts.extend(_zeros(OFFSET_TYPE, source + 2 - len(counts)))
+            counts[source + 1] += 1
+            targets.append(target)
+        for v in range(1, len(counts)):
+            counts[v] += counts[v - 1]
+        return cls(counts, targets)
+
+    @property
+    def size(self):
+        return len(self.offsets) - 1
+
+    # The same edges in the opposite direction, by counting sort
+    def transposed(self):
+        size = max(self.size, max(self.targets, default=-1) + 1)
+        offsets = _zeros(OFFSET_TYPE, size + 1)
+        for target in self.targets:
+            offsets[target + 1] += 1
+        for v in range(1, size + 1):
+            offsets[v] += offsets[v - 1]
+        position = array(OFFSET_TYPE, offsets)
+        targets = _zeros(ID_TYPE, len(self.targets))
+        for source in range(self.size):
+            for target in self.targets[self.offsets[source]:self.offsets[source + 1]]:
+                targets[position[target]] = source
+                position[target] += 1
+        return Adjacency(offsets, targets)
+
+    def _bounds(self, v):
+        if 0 <= v < self.size:
+            return self.offsets[v], self.offsets[v + 1]
+        return 0, 0
+
+    def _in_arrays(self, v, w):
+        lo, hi = self._bounds(v)
+        i = bisect.bisect_left(self.targets, w, lo, hi)
+        return i < hi and self.targets[i] == w
+
+    def contains(self, v, w):
+        if w in self.added.get(v, ()):
+            return True
+        if w in self.removed.get(v, ()):
+            return False
+        return self._in_arrays(v, w)
+
+    def neighbors(self, v):
+        lo, hi = self._bounds(v)
+        row = self.targets[lo:hi]
+        if v in self.added or v in self.removed:
+            row = array(ID_TYPE, sorted(set(row).difference(
+                self.removed.get(v, ())).union(self.added.get(v, ()))))
+        return row
+
+    def degree(self, v):
+        lo, hi = self._bounds(v)
+        return hi - lo + len(self.added.get(v, ())) - len(self.removed.get(v, ()))
+
+    def add(self, v, w):
+        if self.contains(v, w):
+            return
+        if w in self.removed.get(v, ()):
+            self._discard(self.removed, v, w)
+        else:
+            self.added.setdefault(v, set()).add(w)
+            self.pending += 1
+
+    def remove(self, v, w):
+        if not self.contains(v, w):
+            return
+        if w in self.added.get(v, ()):
+            self._discard(self.added, v, w)
+        else:
+            self.removed.setdefault(v, set()).add(w)
+            self.pending += 1
+
+    def _discard(self, deltas, v, w):
+        deltas[v].discard(w)
+        if not deltas[v]:
+            del deltas[v]
+        self.pending -= 1
+
+    # A copy with the pending changes folded into the arrays
+    def compacted(self):
+        changed = set(self.added) | set(self.removed)
+        size = max(self.size, max(self.added, default=-1) + 1)
+        offsets, targets = array(OFFSET_TYPE, [0]), array(ID_TYPE)
+        for v in range(size):
+            if v in changed:
+                targets.extend(self.neighbors(v))
+            elif v < self.size:
+                targets.extend(self.targets[self.offsets[v]:self.offsets[v + 1]])
+            offsets.append(len(targets))
+        return Adjacency(offsets, targets)
+
+    def copy_deltas(self):
+        copy = Adjacency(self.offsets, self.targets)
+        copy.added = {v: set(ws) for v, ws in self.added.items()}
+        copy.removed = {v: set(ws) for v, ws in self.removed.items()}
+        copy.pending = self.pending
+        return copy
+
+    def memory_usage(self):
+        usage = sys.getsizeof(self.offsets) + sys.getsizeof(self.targets)
+        for deltas in (self.added, self.removed):
+            usage += sys.getsizeof(deltas) + sum(
+                sys.getsizeof(ws) for ws in deltas.values())
+        return usage
+
+
+# Ids in both sorted arrays: probes the larger one when the sizes are far
+# apart, hashes otherwise
+def intersect(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    if len(a) * 16 < len(b):
+        result = []
+        for x in a:
+            i = bisect.bisect_left(b, x)
+            if i < len(b) and b[i] == x:
+                result.append(x)
+        return result
+    return sorted(set(a).intersection(b))
+
+
+# The follow graph held in memory as CSR adjacency in both directions (who a
+# user follows, who follows them), for read-side graph queries such as
+# common follows; membership checks behind follow/unfollow stay in SQL
+# Loaded by start() in a background thread, in one streaming pass over the
+# followers primary key; until then (or unless FOLLOW_GRAPH_PRELOAD starts
+# it) queries return None and callers fall back to SQL
+# User.after_commit applies committed follows and unfollows
+# Changes accumulate as per-user deltas, folded into fresh arrays by a
+# background thread once there are FOLLOW_GRAPH_COMPACT_THRESHOLD of them
+# With REDIS_URL configured, each process publishes the changes it commits
+# to the others, and a process whose subscription drops reloads the graph;
+# without it, commits made by other processes only show up when the graph
+# is reloaded every FOLLOW_GRAPH_RELOAD_INTERVAL seconds
+class FollowGraph(object):
+    channel = 'graph:follows'
+
+    def __init__(self, app):
+        self.app = app
+        self.compact_threshold = app.config.get('FOLLOW_GRAPH_COMPACT_THRESHOLD',
+                                                50000)
+        self.reload_interval = app.config.get('FOLLOW_GRAPH_RELOAD_INTERVAL', 300)
+        self.redis = app.redis
+        self._source = uuid.uuid4().hex
+        self._followed = None
+        self._followers = None
+        # Changes applied while the graph is being rebuilt, to replay on
+        # the new arrays
+        self._log = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._reload_periodically, daemon=True).start()
+        if self.redis is not None:
+            threading.Thread(target=self._listen, daemon=True).start()
+
+    def followed(self, user_id):
+        return self._query(lambda followed, followers: followed.neighbors(user_id))
+
+    def followers(self, user_id):
+        return self._query(lambda followed, followers: followers.neighbors(user_id))
+
+    def is_following(self, user_id, followed_id):
+        return self._query(
+            lambda followed, followers: followed.contains(user_id, followed_id))
+
+    def followed_count(self, user_id):
+        return self._query(lambda followed, followers: followed.degree(user_id))
+
+    def followers_count(self, user_id):
+        return self._query(lambda followed, followers: followers.degree(user_id))
+
+    # Users both follow
+    def common_followed(self, user_id, other_id):
+        return self._query(lambda followed, followers: intersect(
+            followed.neighbors(user_id), followed.neighbors(other_id)))
+
+    # Users user_id follows who follow other_id
+    def followed_followers(self, user_id, other_id):
+        return self._query(lambda followed, followers: intersect(
+            followed.neighbors(user_id), followers.neighbors(other_id)))
+
+    # Applies committed (follower_id, followed_id, following) changes
+    def apply(self, changes):
+        if not changes:
+            return
+        with self._lock:
+            self._apply(changes)
+        if self.redis is not None:
+            self.redis.publish(self.channel, json.dumps(
+                {'source': self._source, 'changes': changes}))
+
+    # Rebuilds the graph from followers, which keeps being served (and
+    # changed) meanwhile
+    def reload(self):
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+            self._log = []
+        try:
+            followed, followers = self.load(self.app)
+        except Exception:
+            self.app.logger.exception('Follow graph load failed')
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            log, self._log = self._log, None
+            self._followed, self._followers = followed, followers
+            self._apply(log)
+
+    # Reloads the graph after followers was written to directly (e.g. by a
+    # bulk import), here if it was loaded and in the other processes
+    def clear(self):
+        with self._lock:
+            loaded = self._followed is not None
+        if loaded:
+            threading.Thread(target=self.reload, daemon=True).start()
+        if self.redis is not None:
+            self.redis.publish(self.channel, json.dumps(
+                {'source': self._source, 'reload': True}))
+
+    def memory_usage(self):
+        with self._lock:
+            if self._followed is None:
+                return 0
+            return self._followed.memory_usage() + self._followers.memory_usage()
+
+    # query(followed, followers) on the loaded graph, or None
+    def _query(self, query):
+        with self._lock:
+            if self._followed is None:
+                return None
+            return query(self._followed, self._followers)
+
+    # (followed, followers) adjacency read from the primary database
+    @staticmethod
+    def load(app):
+        with db.get_engine(app).connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(
+                db.select([followers.c.follower_id, followers.c.followed_id]).order_by(
+                    followers.c.follower_id, followers.c.followed_id))
+
+            def pairs():
+                while True:
+                    rows = result.fetchmany(10000)
+                    if not rows:
+                        return
+                    yield from rows
+            followed = Adjacency.from_sorted_pairs(pairs())
+        return followed, followed.transposed()
+
+    # Caller holds the lock
+    def _apply(self, changes):
+        if self._log is not None:
+            self._log.extend(changes)
+        if self._followed is None:
+            return
+        for follower_id, followed_id, following in changes:
+            if following:
+                self._followed.add(follower_id, followed_id)
+                self._followers.add(followed_id, follower_id)
+            else:
+                self._followed.remove(follower_id, followed_id)
+                self._followers.remove(followed_id, follower_id)
+        if self._log is None and self._followed.pending + \
+                self._followers.pending >= self.compact_threshold:
+            self._log = []
+            threading.Thread(target=self._compact, args=(
+                self._generation, self._followed.copy_deltas(),
+                self._followers.copy_deltas()), daemon=True).start()
+
+    # Builds compacted arrays off the lock, then swaps them in and replays
+    # the changes applied meanwhile
+    def _compact(self, generation, followed, followers):
+        try:
+            followed, followers = followed.compacted(), followers.compacted()
+        except Exception:
+            self.app.logger.exception('Follow graph compaction failed')
+            followed = None
+        with self._lock:
+            # A reload started since owns the log
+            if generation != self._generation:
+                return
+            log, self._log = self._log, None
+            if followed is None:
+                return
+            self._followed, self._followers = followed, followers
+            self._apply(log)
+
+    def _reload_periodically(self):
+        while True:
+            self.reload()
+            if self.redis is not None or not self.reload_interval:
+                return
+            time.sleep(self.reload_interval)
+
+    def _listen(self):
+        subscribed = False
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # Changes published while unsubscribed were missed
+                if subscribed:
+                    self.reload()
+                subscribed = True
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    data = json.loads(message['data'])
+                    if data['source'] == self._source:
+                        continue
+                    if data.get('reload'):
+                        self.reload()
+                        continue
+                    with self._lock:
+                        self._apply([tuple(change)
+                                     for change in data['changes']])
+            except Exception:
+                self.app.logger.exception('Follow graph listener failed')
+                time.sleep(1)
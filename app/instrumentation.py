@@ -0,0 +1,208 @@
+import bisect
+import hmac
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, abort, before_render_template, g, \
+    has_request_context, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# Process-wide histograms and counters rendered in Prometheus text format
+class Metrics(object):
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(BUCKETS), 0, 0.0]
+            index = bisect.bisect_left(BUCKETS, value)
+            if index < len(BUCKETS):
+                histogram[0][index] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def render(self):
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        seen = set()
+        for (name, labels), (buckets, count, total) in histograms:
+            if name not in seen:
+                lines.append('# TYPE {} histogram'.format(name))
+                seen.add(name)
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                lines.append('{}_bucket{} {}'.format(
+                    name, _labels(labels + (('le', repr(bound)),)), cumulative))
+            lines.append('{}_bucket{} {}'.format(
+                name, _labels(labels + (('le', '+Inf'),)), count))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), total))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), count))
+        for (name, labels), value in counters:
+            if name not in seen:
+                lines.append('# TYPE {} counter'.format(name))
+                seen.add(name)
+            lines.append('{}{} {}'.format(name, _labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+# Per-request accumulator kept on g by the before_request hook
+class RequestTimings(object):
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = []
+        self.durations = {'db': 0.0, 'tpl': 0.0, 'search': 0.0}
+        self.counts = {'db': 0, 'tpl': 0, 'search': 0}
+        self.template_starts = []
+
+    def add(self, kind, duration):
+        self.durations[kind] += duration
+        self.counts[kind] += 1
+
+
+def current_timings():
+    if has_request_context():
+        return g.get('timings')
+    return None
+
+
+# Times a block (e.g. a search backend call) against the current request
+@contextmanager
+def timed(kind):
+    timings = current_timings()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings.add(kind, time.perf_counter() - start)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = conn.info['query_start'].pop()
+    timings = current_timings()
+    if timings is not None:
+        duration = time.perf_counter() - start
+        timings.add('db', duration)
+        timings.queries.append((duration, statement))
+
+
+# Failed statements never reach after_cursor_execute, so their start time
+# is dropped here
+def _handle_error(context):
+    if context.connection is None:
+        return
+    starts = context.connection.info.get('query_start')
+    if starts:
+        starts.pop()
+
+
+# Nested renders (e.g. _post.html fragments) count towards the outermost one
+def _before_render_template(sender, template, context, **extra):
+    timings = current_timings()
+    if timings is not None:
+        timings.template_starts.append(time.perf_counter())
+
+
+def _template_rendered(sender, template, context, **extra):
+    timings = current_timings()
+    if timings is not None and timings.template_starts:
+        start = timings.template_starts.pop()
+        if not timings.template_starts:
+            timings.add('tpl', time.perf_counter() - start)
+
+
+# Registers SQL, template and request hooks, the Server-Timing header, the
+# slow request log and the Prometheus /metrics endpoint on app
+# /metrics answers only scrapers sending "Authorization: Bearer
+# <METRICS_TOKEN>", and doesn't exist unless METRICS_TOKEN is configured
+def init_app(app):
+    app.metrics = Metrics()
+    slow_threshold = app.config.get('SLOW_REQUEST_THRESHOLD', 0.5)
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+    before_render_template.connect(_before_render_template, app)
+    template_rendered.connect(_template_rendered, app)
+
+    @app.before_request
+    def start_timings():
+        g.timings = RequestTimings()
+
+    @app.after_request
+    def record_timings(response):
+        timings = g.pop('timings', None)
+        if timings is None:
+            return response
+        total = time.perf_counter() - timings.start
+        endpoint = request.endpoint or 'unknown'
+        response.headers['Server-Timing'] = ', '.join(
+            ['{};dur={:.1f};desc="{} calls"'.format(
+                kind, timings.durations[kind] * 1000, timings.counts[kind])
+             for kind in ('db', 'tpl', 'search')] +
+            ['total;dur={:.1f}'.format(total * 1000)])
+        labels = {'endpoint': endpoint}
+        app.metrics.observe('microblog_request_duration_seconds', labels, total)
+        app.metrics.observe('microblog_sql_duration_seconds', labels,
+                            timings.durations['db'])
+        app.metrics.observe('microblog_template_duration_seconds', labels,
+                            timings.durations['tpl'])
+        app.metrics.observe('microblog_search_duration_seconds', labels,
+                            timings.durations['search'])
+        app.metrics.inc('microblog_sql_queries_total', labels,
+                        timings.counts['db'])
+        app.metrics.inc('microblog_requests_total',
+                        dict(labels, status=response.status_code))
+        if total >= slow_threshold:
+            top = sorted(timings.queries, key=lambda q: q[0], reverse=True)[:5]
+            app.logger.warning(
+                'Slow request %s %s: %.1fms, %d queries (%.1fms)\n%s',
+                request.method, request.path, total * 1000, timings.counts['db'],
+                timings.durations['db'] * 1000,
+                '\n'.join('  {:.1f}ms {}'.format(d * 1000, ' '.join(s.split()))
+                          for d, s in top))
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        token = app.config.get('METRICS_TOKEN')
+        if not token:
+            abort(404)
+        if not hmac.compare_digest(
+                request.headers.get('Authorization', '').encode('utf-8'),
+                'Bearer {}'.format(token).encode('utf-8')):
+            abort(401)
+        return Response(app.metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
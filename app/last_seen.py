@@ -0,0 +1,41 @@
+import threading
+import time
+from datetime import datetime
+
+from app import db
+
+
+# Buffers last_seen timestamps in memory and writes them in one bulk UPDATE
+# at most every LAST_SEEN_FLUSH_INTERVAL seconds, so page views don't turn
+# into write transactions (or fire the session's commit hooks)
+class LastSeenBuffer(object):
+    def __init__(self, app):
+        self.app = app
+        self.flush_interval = app.config.get('LAST_SEEN_FLUSH_INTERVAL', 60)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+
+    def touch(self, user_id, when=None):
+        with self._lock:
+            self._pending[user_id] = when or datetime.utcnow()
+            due = time.time() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+        if not pending:
+            return
+        # Imported here because app.models imports from the app package
+        from app.models import User
+        user = User.__table__
+        # Core executemany on its own connection, outside the ORM session
+        with db.get_engine(self.app).begin() as conn:
+            conn.execute(
+                user.update().where(user.c.id == db.bindparam('user_id')).values(
+                    last_seen=db.bindparam('last_seen')),
+                [{'user_id': user_id, 'last_seen': last_seen}
+                 for user_id, last_seen in pending.items()])
@@ -0,0 +1,266 @@
+import copy
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, SMTPHandler, \
+    TimedRotatingFileHandler
+
+from flask import has_request_context, request
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
+_formatter = logging.Formatter()
+
+
+# Log pipeline for production: app.logger only puts records on a bounded
+# in-memory queue, and a QueueListener thread writes them as JSON lines to
+# a log file rotated daily and by size, and hands errors to a digest mailer
+# Records are dropped (and counted) rather than blocking a request when the
+# queue is full
+class LogPipeline(object):
+    def __init__(self, app):
+        self.queue = queue.Queue(maxsize=app.config.get('LOG_QUEUE_SIZE', 10000))
+        self.handler = _NonBlockingQueueHandler(self.queue)
+        self.handler.addFilter(RequestContextFilter())
+        handlers = [self._file_handler(app)]
+        self.digest = self._digest_handler(app)
+        if self.digest is not None:
+            handlers.append(self.digest)
+        self.listener = QueueListener(self.queue, *handlers,
+                                      respect_handler_level=True)
+        self.listener.start()
+        app.logger.addHandler(self.handler)
+
+    @property
+    def dropped(self):
+        return self.handler.dropped
+
+    # Writes out everything queued so far and sends the pending digest
+    def close(self):
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+
+    @staticmethod
+    def _file_handler(app):
+        directory = app.config.get('LOG_DIR', 'logs')
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+        handler = SizedTimedRotatingFileHandler(
+            os.path.join(directory, 'microblog.log'),
+            when=app.config.get('LOG_ROTATE_WHEN', 'midnight'),
+            max_bytes=app.config.get('LOG_MAX_BYTES', 100 * 1024 * 1024),
+            backup_count=app.config.get('LOG_BACKUP_COUNT', 30))
+        handler.setFormatter(JSONFormatter())
+        handler.setLevel(logging.INFO)
+        return handler
+
+    # Server must be configured in config.py
+    @staticmethod
+    def _digest_handler(app):
+        config = app.config
+        if not config.get('MAIL_SERVER') or not config.get('ADMINS'):
+            return None
+        auth = None
+        if config.get('MAIL_USERNAME') or config.get('MAIL_PASSWORD'):
+            auth = (config.get('MAIL_USERNAME'), config.get('MAIL_PASSWORD'))
+        secure = () if config.get('MAIL_USE_TLS') else None
+        mailer = _DigestMailer(
+            mailhost=(config['MAIL_SERVER'], config.get('MAIL_PORT', 25)),
+            fromaddr='no-reply@' + config['MAIL_SERVER'],
+            toaddrs=config['ADMINS'], subject='Microblog Failure',
+            credentials=auth, secure=secure, timeout=10)
+        handler = ErrorDigestHandler(
+            mailer, interval=config.get('LOG_MAIL_INTERVAL', 300),
+            delay=config.get('LOG_MAIL_DELAY', 10),
+            max_records=config.get('LOG_MAIL_MAX_RECORDS', 100))
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+        return handler
+
+
+# Enqueues without blocking, and keeps the traceback text on the record so
+# formatters on the listener side can still place it
+class _NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, queue):
+        QueueHandler.__init__(self, queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = _formatter.formatException(record.exc_info)
+            record.exc_info = None
+        if record.stack_info:
+            record.stack_info = _formatter.formatStack(record.stack_info)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# Copies request details onto records while still on the request thread
+class RequestContextFilter(logging.Filter):
+    def filter(self, record):
+        if has_request_context():
+            record.request = {'method': request.method, 'path': request.path,
+                              'endpoint': request.endpoint,
+                              'remote_addr': request.remote_addr}
+        return True
+
+
+# One JSON object per line
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'path': record.pathname,
+            'line': record.lineno,
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        request = getattr(record, 'request', None)
+        if request:
+            entry['request'] = request
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = record.stack_info
+        return json.dumps(entry, default=str)
+
+
+# TimedRotatingFileHandler that also rolls over when the file would grow
+# past max_bytes; extra files for the same interval get a numeric suffix
+# (microblog.log.2020-01-01.001), which backup_count pruning still matches
+class SizedTimedRotatingFileHandler(TimedRotatingFileHandler):
+    def __init__(self, filename, when='midnight', max_bytes=0, backup_count=0):
+        TimedRotatingFileHandler.__init__(self, filename, when=when,
+                                          backupCount=backup_count,
+                                          encoding='utf-8', delay=True)
+        self.max_bytes = max_bytes
+        self._by_size = False
+
+    def shouldRollover(self, record):
+        self._by_size = False
+        if TimedRotatingFileHandler.shouldRollover(self, record):
+            return True
+        if self.max_bytes <= 0:
+            return False
+        if self.stream is None:
+            self.stream = self._open()
+        self.stream.seek(0, 2)
+        position = self.stream.tell()
+        size = len((self.format(record) + self.terminator).encode('utf-8'))
+        self._by_size = position > 0 and position + size > self.max_bytes
+        return self._by_size
+
+    def doRollover(self):
+        rollover_at = self.rolloverAt
+        TimedRotatingFileHandler.doRollover(self)
+        # A size rollover doesn't move the next scheduled one
+        if self._by_size:
+            self.rolloverAt = rollover_at
+
+    def rotation_filename(self, default_name):
+        name, n = default_name, 0
+        while os.path.exists(name):
+            n += 1
+            name = '{}.{:03d}'.format(default_name, n)
+        return name
+
+
+class _DigestMailer(SMTPHandler):
+    def getSubject(self, record):
+        return record.subject
+
+
+# Collects error records and mails them to the admins in batches, from its
+# own thread so neither requests nor the log listener wait on SMTP
+# A digest goes out `delay` seconds after the first error it holds (so a
+# burst arrives in one mail), and at most once per `interval` seconds;
+# records past max_records are only counted
+class ErrorDigestHandler(logging.Handler):
+    def __init__(self, mailer, interval=300, delay=10, max_records=100):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.mailer = mailer
+        self.interval = interval
+        self.delay = delay
+        self.max_records = max_records
+        self._records = []
+        self._omitted = 0
+        self._first = None
+        self._last_sent = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def emit(self, record):
+        try:
+            text = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        with self._cond:
+            if self._closed:
+                return
+            if len(self._records) < self.max_records:
+                self._records.append(text)
+            else:
+                self._omitted += 1
+            if self._first is None:
+                self._first = time.time()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    # Sends what is pending right away and stops the thread
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        logging.Handler.close(self)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._records and not self._closed:
+                    self._cond.wait()
+                while self._records and not self._closed:
+                    due = self._first + self.delay
+                    if self._last_sent is not None:
+                        due = max(due, self._last_sent + self.interval)
+                    if time.time() >= due:
+                        break
+                    self._cond.wait(due - time.time())
+                if not self._records:
+                    return
+                records, omitted = self._records, self._omitted
+                self._records, self._omitted, self._first = [], 0, None
+                self._last_sent = time.time()
+            self._send(records, omitted)
+
+    def _send(self, records, omitted):
+        count = len(records) + omitted
+        body = '\n\n'.join(records)
+        if omitted:
+            body += '\n\n... and {} more'.format(omitted)
+        self.mailer.handle(logging.makeLogRecord({
+            'msg': body, 'levelno': logging.ERROR, 'levelname': 'ERROR',
+            'subject': 'Microblog Failure: {} error{}'.format(
+                count, '' if count == 1 else 's')}))
@@ -1,14 +1,19 @@
-from datetime import datetime
+import json
 
-from flask import current_app, flash, g, redirect, render_template, request, url_for
+from flask import Response, current_app, flash, g, redirect, render_template, \
+    request, stream_with_context, url_for
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
-from guess_language import guess_language
 
 from app import db
 from app.main import bp
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm
-from app.models import Post, User
+from app.models import Post, User, current_content_version, followers, timeline
+from app.conditional import PageValidators
+from app.fragments import render_post
+from app.pagination import latest_key, paginate_keyset
+from app.posts import create_post, search_posts
+from app.stream import snapshot
 from app.auth.email import send_password_reset_email
 
 
@@ -18,24 +23,92 @@ from app.auth.email import send_password_reset_email
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        language = guess_language(form.post.data)
-        if language == 'UNKNOWN' or len(language) > 5:
-            language = ''
-        post = Post(body=form.post.data, author=current_user, language=language)
-        db.session.add(post)
-        db.session.commit()
+        create_post(current_user, form.post.data)
         flash(_('Your post is now live!'))
         # Redirect to index to avoid extra submit on browser refresh
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.index', page=posts.next_num) \
+    # followed_count covers unfollows, which can drop posts from the feed
+    # without changing its newest one
+    latest = latest_key(db.session.query(timeline).filter(
+        timeline.c.user_id == current_user.id), timeline.c.timestamp,
+        timeline.c.post_id)
+    suggestions = current_user.suggestions(
+        current_app.config.get('SUGGESTIONS_SHOWN', 5))
+    validators = PageValidators(latest and latest[0], 'index', latest,
+                                current_content_version(),
+                                current_user.followed_count,
+                                _suggestion_keys(suggestions))
+    if validators.not_modified():
+        return validators.response()
+    cursor = request.args.get('cursor')
+    posts = paginate_keyset(current_user.followed_posts(), timeline.c.timestamp,
+        timeline.c.post_id, cursor, current_app.config['POSTS_PER_PAGE'])
+    next_url = url_for('main.index', cursor=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) \
+    prev_url = url_for('main.index', cursor=posts.prev_cursor) \
         if posts.has_prev else None
-    return render_template('index.html', title=_('Home'), form=form,
-        posts=posts.items, next_url=next_url, prev_url=prev_url)
+    return validators.response(render_template('index.html', title=_('Home'),
+        form=form, posts=posts.items, next_url=next_url, prev_url=prev_url,
+        suggestions=suggestions))
+
+
+# What the suggestions panel shows, for page validators
+def _suggestion_keys(suggestions):
+    return [(user.id, user.revision, mutual) for user, mutual in suggestions]
+
+
+# Server-Sent Events stream of new posts from followed users (and the
+# viewer's own), rendered as _post.html fragments for the index page
+# A reconnecting client gets the posts it missed after Last-Event-ID first
+# The database session is closed before waiting, so idle streams hold no
+# connection
+@bp.route('/stream')
+@login_required
+def stream():
+    authors = [row[0] for row in db.session.execute(
+        db.select([followers.c.followed_id]).where(
+            followers.c.follower_id == current_user.id))] + [current_user.id]
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    heartbeat = current_app.config.get('STREAM_HEARTBEAT', 15)
+    bus = current_app.post_bus
+
+    def events():
+        subscription = bus.subscribe(authors)
+        if subscription is None:
+            yield 'event: busy\ndata: \n\n'
+            return
+        try:
+            sent = set()
+            if last_id is not None:
+                missed = Post.query.filter(Post.user_id.in_(authors),
+                    Post.id > last_id).order_by(Post.id).limit(bus.queue_size)
+                for post in missed:
+                    sent.add(post.id)
+                    yield _event('post', post.id, render_post(post))
+            db.session.close()
+            yield ': connected\n\n'
+            while True:
+                new, overflowed = subscription.get(heartbeat)
+                if overflowed:
+                    yield 'event: resync\ndata: \n\n'
+                    return
+                if not new:
+                    yield ': keepalive\n\n'
+                for event in new:
+                    if event['id'] not in sent:
+                        yield _event('post', event['id'],
+                                     render_post(snapshot(event)))
+        finally:
+            bus.unsubscribe(subscription)
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+def _event(name, id, html):
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+        id, name, json.dumps({'id': id, 'html': html}))
 
 
 # Profile pages
@@ -45,21 +118,32 @@ def user(username):     # username comes from <username> in decorator
     form = EmptyForm()
     post_form = PostForm()
     if post_form.validate_on_submit():
-        post = Post(body=post_form.post.data, author=current_user)
-        db.session.add(post)
-        db.session.commit()
+        create_post(current_user, post_form.post.data)
         flash(_('Your post is now live!'))
         return redirect(url_for('main.user', username=username))
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.user', username=username, page=posts.next_num) \
-        if posts.next_num else None
-    prev_url = url_for('main.user', username=username, page=posts.prev_num) \
-        if posts.prev_num else None
-    return render_template('user.html', user=user, posts=posts.items,
-        form=form, next_url=next_url, prev_url=prev_url, post_form=post_form)
+    latest = latest_key(user.posts, Post.timestamp, Post.id)
+    # Own profiles show follow suggestions
+    suggestions = current_user.suggestions(
+        current_app.config.get('SUGGESTIONS_SHOWN', 5)) \
+        if user == current_user else []
+    # Everything the profile header shows comes from the user row
+    validators = PageValidators(latest and latest[0], 'user', latest,
+        current_content_version(), user.id, user.revision, user.about_me, user.last_seen,
+        user.posts_count, user.followers_count, user.followed_count,
+        current_user.is_following(user), _suggestion_keys(suggestions))
+    if validators.not_modified():
+        return validators.response()
+    cursor = request.args.get('cursor')
+    posts = paginate_keyset(user.posts, Post.timestamp, Post.id, cursor,
+        current_app.config['POSTS_PER_PAGE'])
+    next_url = url_for('main.user', username=username, cursor=posts.next_cursor) \
+        if posts.has_next else None
+    prev_url = url_for('main.user', username=username, cursor=posts.prev_cursor) \
+        if posts.has_prev else None
+    return validators.response(render_template('user.html', user=user,
+        posts=posts.items, form=form, next_url=next_url, prev_url=prev_url,
+        post_form=post_form, suggestions=suggestions))
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -67,8 +151,9 @@ def user(username):     # username comes from <username> in decorator
 def edit_profile():
     form = EditProfileForm(current_user.username)
     if form.validate_on_submit():
-        current_user.username = form.username.data
-        current_user.about_me = form.about_me.data
+        user = current_user.attached()
+        user.username = form.username.data
+        user.about_me = form.about_me.data
         db.session.commit()
         flash(_('Your changes have been saved.'))
         return redirect(url_for('main.edit_profile'))
@@ -94,7 +179,7 @@ def follow(username):
         if user == current_user:
             flash(_('You cannot follow yourself.'))
             return redirect(url_for('main.index'))
-        current_user.follow(user)
+        current_user.attached().follow(user)
         db.session.commit()
         flash(_('You are now following %(username)s', username=username))
         return redirect(url_for('main.user', username=username))
@@ -116,7 +201,7 @@ def unfollow(username):
         if user == current_user:
             flash(_('You cannot unfollow yourself.'))
             return redirect(url_for('main.index'))
-        current_user.unfollow(user)
+        current_user.attached().unfollow(user)
         db.session.commit()
         flash(_('You are no longer following %(username)s.', username=username))
         return redirect(url_for('main.user', username=username))
@@ -128,21 +213,32 @@ def unfollow(username):
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.explore', page=posts.next_num) \
+    recent = current_app.recent_posts
+    latest = recent.latest() or latest_key(Post.query, Post.timestamp, Post.id)
+    trending = current_app.trending.top(current_app.config.get('TRENDING_SHOWN', 10))
+    validators = PageValidators(latest and latest[0], 'explore', latest,
+                                current_content_version(),
+                                [term for term, _ in trending])
+    if validators.not_modified():
+        return validators.response()
+    cursor = request.args.get('cursor')
+    # The first pages come from the recent posts window, deeper ones from SQL
+    posts = recent.paginate(cursor, current_app.config['POSTS_PER_PAGE']) or \
+        paginate_keyset(Post.query, Post.timestamp, Post.id, cursor,
+                        current_app.config['POSTS_PER_PAGE'])
+    next_url = url_for('main.explore', cursor=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
+    prev_url = url_for('main.explore', cursor=posts.prev_cursor) \
         if posts.has_prev else None
-    return render_template('index.html', title='Explore', posts=posts.items, next_url=next_url, prev_url=prev_url)
+    return validators.response(render_template('index.html', title='Explore',
+        posts=posts.items, next_url=next_url, prev_url=prev_url,
+        trending=trending))
 
 
 @bp.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        current_app.last_seen.touch(current_user.id)
         # g container persists for entirety of application context
         # so it's a good place to store SearchForm
         g.search_form = SearchForm()
@@ -155,8 +251,8 @@ def search():
     if not g.search_form.validate():
         return redirect(url_for('main.explore'))
     page = request.args.get('page', 1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page,
-                               current_app.config['POSTS_PER_PAGE'])
+    posts, total = search_posts(g.search_form.q.data, page,
+                                current_app.config['POSTS_PER_PAGE'])
     next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
         if total > page * current_app.config['POSTS_PER_PAGE'] else None
     prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
@@ -3,26 +3,107 @@ from hashlib import md5
 from time import time
 import jwt
 
-from flask import current_app
+from flask import current_app, g
 from flask_login import UserMixin
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.sql import ClauseElement
 
 from werkzeug.security import check_password_hash, generate_password_hash
 
-from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app import db, login, replicas
+from app.search import add_to_index, bulk_index, query_index, remove_from_index
 
 
 # Followers table
+# Composite primary key makes membership checks index lookups and rules out
+# duplicate edges; the reverse index serves "who follows X" for fan-out
 followers = db.Table('followers',
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Index('ix_followers_followed_id', 'followed_id', 'follower_id')
 )
 
+# Materialized home timelines, one row per (owner, post) pair
+# Rows are pushed when posts are flushed and backfilled on follow, so reading
+# a page of the home feed is an index range scan instead of a UNION + sort
+timeline = db.Table('timeline',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+    db.Column('timestamp', db.DateTime),
+    db.Index('ix_timeline_user_id_timestamp', 'user_id', 'timestamp', 'post_id')
+)
+
+# Users whose timeline has been built, so an empty feed isn't mistaken for
+# a missing one; posts are only pushed into built timelines
+timeline_built = db.Table('timeline_built',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True)
+)
+
+# Precomputed "who to follow" suggestions, best first by score, rewritten by
+# `flask suggestions compute`; mutual is how many of the user's followed
+# users follow the suggested one
+suggestion = db.Table('suggestion',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('suggested_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('score', db.Float),
+    db.Column('mutual', db.Integer),
+    db.Index('ix_suggestion_user_id_score', 'user_id', 'score')
+)
+
+# Single-row version of everything feeds render inside posts besides new
+# posts: bumped in the same transaction as post edits and deletes, author
+# renames and languages filled in later, so feed ETags can cover them
+content_version = db.Table('content_version',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('version', db.Integer, nullable=False)
+)
+
+
+def bump_content_version(conn):
+    result = conn.execute(content_version.update().where(
+        content_version.c.id == 1).values(version=content_version.c.version + 1))
+    if result.rowcount == 0:
+        conn.execute(content_version.insert().values(id=1, version=1))
+
+
+def current_content_version():
+    return db.session.query(content_version.c.version).filter(
+        content_version.c.id == 1).scalar() or 0
+
+
+# Adds delta to a counter column, as an atomic SQL expression for rows that
+# already exist (composing with increments not flushed yet)
+def increment(obj, attr, delta):
+    current = obj.__dict__.get(attr)
+    if isinstance(current, ClauseElement):
+        setattr(obj, attr, current + delta)
+    elif db.inspect(obj).persistent:
+        setattr(obj, attr, getattr(type(obj), attr) + delta)
+    else:
+        setattr(obj, attr, (getattr(obj, attr) or 0) + delta)
+
+
+# Gravatar identifies users by the md5 of their lowercased email, which is
+# all that leaves the users table (search documents store only the digest)
+def avatar_digest(email):
+    return md5(email.lower().encode('utf-8')).hexdigest()
+
+
+def avatar_prefix(digest):
+    return 'https://www.gravatar.com/avatar/' + digest + '?d=identicon&s='
+
+
+# Objects in first-seen order, without repeats
+def _unique(objs):
+    return list(dict.fromkeys(objs))
+
 
 class SearchableMixin(object):
     @classmethod
     def search(cls, expression, page, per_page):
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
+        ids, total = query_index(cls.__tablename__, expression, page, per_page,
+                                 cls.__searchable__)
         if total == 0:
             return cls.query.filter_by(id=0), 0
         when = []
@@ -32,36 +113,76 @@ class SearchableMixin(object):
         return cls.query.filter(cls.id.in_(ids)).order_by(
             db.case(when, value=cls.id)), total
 
+    def search_document(self):
+        return {field: getattr(self, field) for field in self.__searchable__}
+
+    # Records the objects each flush writes, since autoflush can write
+    # changes well before the commit
+    @classmethod
+    def before_flush(cls, session, flush_context, instances):
+        pending = getattr(session, '_pending_changes', None)
+        if pending is None:
+            pending = session._pending_changes = {
+                'add': [], 'update': [], 'delete': []}
+        pending['add'].extend(session.new)
+        pending['update'].extend(session.dirty)
+        pending['delete'].extend(session.deleted)
+
     # before_commit saves changes to a place that won't be deleted after commit
+    # Flushing first assigns ids to new objects, so index documents can be
+    # built now instead of reloading every expired object after the commit
     @classmethod
     def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
+        session.flush()
+        pending = getattr(session, '_pending_changes', None) or {
+            'add': [], 'update': [], 'delete': []}
+        session._pending_changes = None
+        deleted = _unique(pending['delete'])
+        added = [obj for obj in _unique(pending['add']) if obj not in deleted]
+        skip = set(added + deleted)
+        changes = {
+            'add': added,
+            'update': [obj for obj in _unique(pending['update']) if obj not in skip],
+            'delete': deleted
         }
+        changes['index'] = [
+            (obj.__tablename__, obj.id, obj.search_document())
+            for obj in changes['add'] + changes['update']
+            if isinstance(obj, SearchableMixin)]
+        session._changes = changes
 
-    # Adds saved changes to index after sql commit
+    # Queues saved changes for indexing after sql commit
     @classmethod
     def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
+        for index, id, payload in session._changes['index']:
+            add_to_index(index, id, payload)
         for obj in session._changes['delete']:
-            remove_from_index(obj.__tablename__, obj)
+            if isinstance(obj, SearchableMixin):
+                remove_from_index(obj.__tablename__, obj.id)
         session._changes = None
 
     @classmethod
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    def after_rollback(cls, session):
+        session._pending_changes = None
 
+    # Streams rows in id order, one chunk at a time, through the bulk path
+    @classmethod
+    def reindex(cls, chunk_size=1000):
+        last_id = 0
+        while True:
+            chunk = cls.query.filter(cls.id > last_id).order_by(cls.id).limit(
+                chunk_size).all()
+            if not chunk:
+                break
+            bulk_index(cls.__tablename__,
+                       [(obj.id, obj.search_document()) for obj in chunk])
+            last_id = chunk[-1].id
 
+
+db.event.listen(db.session, 'before_flush', SearchableMixin.before_flush)
 db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
 
 
 class User(UserMixin, db.Model):
@@ -70,9 +191,20 @@ class User(UserMixin, db.Model):
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
     password_hash = db.Column(db.String(128))
-    posts = db.relationship('Post', backref='author', lazy='dynamic')
+    # Authors are joined into every post query so feeds rendering
+    # post.author never issue one SELECT per row; repeated authors resolve
+    # through the session identity map, which lives for one request
+    posts = db.relationship('Post', backref=db.backref('author', lazy='joined'),
+                            lazy='dynamic')
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    # Denormalized counters kept in step by follow/unfollow and Post.after_flush
+    # Recompute with `flask counters recompute`
+    followers_count = db.Column(db.Integer, default=0)
+    followed_count = db.Column(db.Integer, default=0)
+    posts_count = db.Column(db.Integer, default=0)
+    # Bumped when fields shown next to every post change, to version caches
+    revision = db.Column(db.Integer, default=0)
     # Left side is followed users, right side is followers
     # lazy indicates that query will only run when specifically requested
     followed = db.relationship(
@@ -84,6 +216,21 @@ class User(UserMixin, db.Model):
     def __repr__(self):
         return '<User {}>'.format(self.username)
 
+    REVISION_FIELDS = ('username', 'email')
+
+    @db.validates(*REVISION_FIELDS)
+    def bump_revision(self, key, value):
+        if db.inspect(self).persistent and getattr(self, key) != value:
+            increment(self, 'revision', 1)
+        return value
+
+    # Users loaded by the cached user_loader are detached from the session;
+    # views that change one, or walk its relationships, use the attached copy
+    def attached(self):
+        if db.inspect(self).detached:
+            return db.session.merge(self, load=False)
+        return self
+
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
 
@@ -92,34 +239,113 @@ class User(UserMixin, db.Model):
 
     # Avatars hosted on Gravatar
     # Uses hashed email addresses (lowercase) to identify user
+    # The URL prefix is computed once per email and memoized on the instance
+    _avatar_email = None
+    _avatar_prefix = None
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(
-            digest, size)
+        if self._avatar_email != self.email:
+            self._avatar_prefix = avatar_prefix(avatar_digest(self.email))
+            self._avatar_email = self.email
+        return self._avatar_prefix + str(size)
 
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            self.followed_ids().add(user.id)
+            increment(self, 'followed_count', 1)
+            increment(user, 'followers_count', 1)
+            # Backfill followed user's posts into an already built timeline
+            if self.has_timeline():
+                db.session.execute(timeline.insert().from_select(
+                    ['user_id', 'post_id', 'timestamp'],
+                    db.select([db.literal(self.id), Post.id, Post.timestamp]).where(
+                        Post.user_id == user.id)))
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            self.followed_ids().discard(user.id)
+            increment(self, 'followed_count', -1)
+            increment(user, 'followers_count', -1)
+            db.session.execute(timeline.delete().where(db.and_(
+                timeline.c.user_id == self.id,
+                timeline.c.post_id.in_(
+                    db.select([Post.id]).where(Post.user_id == user.id)))))
+
+    # Ids of followed users, loaded once per request (app context) and kept
+    # in step by follow/unfollow
+    def followed_ids(self):
+        cache = g.setdefault('followed_ids', {})
+        if self.id not in cache:
+            cache[self.id] = {row[0] for row in db.session.query(
+                followers.c.followed_id).filter(followers.c.follower_id == self.id)}
+        return cache[self.id]
 
-    # filter() works for variable conditions, unlike filter_by()
-    # Returns true if there is a matching user in followed column
     def is_following(self, user):
-        return self.followed.filter(
-            followers.c.followed_id == user.id).count() > 0
+        return user.id in self.followed_ids()
+
+    # Ids of users both this user and user follow, from the follow graph
+    # (or SQL while it is loading)
+    def common_followed_ids(self, user):
+        ids = current_app.follow_graph.common_followed(self.id, user.id)
+        if ids is None:
+            ids = sorted(self.followed_ids() & user.followed_ids())
+        return ids
+
+    # Ids of users this user follows who follow user
+    def followed_followers_ids(self, user):
+        ids = current_app.follow_graph.followed_followers(self.id, user.id)
+        if ids is None:
+            ids = sorted(self.followed_ids().intersection(
+                row[0] for row in db.session.query(followers.c.follower_id).filter(
+                    followers.c.followed_id == user.id)))
+        return ids
 
-    # Join posts table and followers table on user_id/followed_id
-    # Filter joint table for entries where the follower_id is current user's id
-    # Return union of own posts and followed posts in chronological order
+    # (user, mutual) pairs from the precomputed suggestions, best first,
+    # leaving out users followed since they were computed
+    def suggestions(self, limit=5):
+        rows = db.session.query(User, suggestion.c.mutual).join(
+            suggestion, suggestion.c.suggested_id == User.id).filter(
+                suggestion.c.user_id == self.id).order_by(
+                    suggestion.c.score.desc(), User.id).limit(limit * 2)
+        return [(user, mutual) for user, mutual in rows
+                if not self.is_following(user)][:limit]
+
+    # Own posts and followed posts in reverse chronological order, read from
+    # the materialized timeline (built from the source tables when missing)
     def followed_posts(self):
-        followed = Post.query.join(
-            followers, followers.c.followed_id == Post.user_id).filter(
-                followers.c.follower_id == self.id)
-        own = Post.query.filter_by(user_id=self.id)
-        return followed.union(own).order_by(Post.timestamp.desc())
+        if not self.has_timeline():
+            self.rebuild_timeline()
+        return Post.query.join(timeline, timeline.c.post_id == Post.id).filter(
+            timeline.c.user_id == self.id).order_by(
+                timeline.c.timestamp.desc(), timeline.c.post_id.desc())
+
+    def has_timeline(self):
+        return db.session.query(db.exists().where(
+            timeline_built.c.user_id == self.id)).scalar()
+
+    # Replaces timeline rows with own posts plus posts from followed users
+    # Runs in a transaction of its own on the primary, so reads never commit
+    # the request's session (or fire its commit hooks); when two requests
+    # build the same timeline at once, the first one wins
+    def rebuild_timeline(self):
+        followed_ids = db.select([followers.c.followed_id]).where(
+            followers.c.follower_id == self.id)
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(timeline_built.delete().where(
+                    timeline_built.c.user_id == self.id))
+                conn.execute(timeline.delete().where(timeline.c.user_id == self.id))
+                conn.execute(timeline.insert().from_select(
+                    ['user_id', 'post_id', 'timestamp'],
+                    db.select([db.literal(self.id), Post.id, Post.timestamp]).where(
+                        db.or_(Post.user_id == self.id,
+                               Post.user_id.in_(followed_ids)))))
+                conn.execute(timeline_built.insert().values(user_id=self.id))
+        except IntegrityError:
+            pass
+        replicas.wrote()
 
     # Reset password token with expiration of 10 minutes
     # Password token payload is 'reset_password': userid, 'exp':token_expiration
@@ -138,19 +364,231 @@ class User(UserMixin, db.Model):
             return
         return User.query.get(id)
 
+    # Stages follow/unfollow edges written by the flush for the follow graph
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        changes = []
+        for obj in session.new | session.dirty:
+            if isinstance(obj, User):
+                history = db.inspect(obj).attrs.followed.history
+                changes.extend((obj.id, user.id, True) for user in history.added)
+                changes.extend((obj.id, user.id, False) for user in history.deleted)
+        if changes:
+            if not getattr(session, '_follow_changes', None):
+                session._follow_changes = []
+            session._follow_changes.extend(changes)
+
+    # Applies committed follows to the follow graph and bumps the cached
+    # version of users changed by the commit
+    # Registered ahead of SearchableMixin.after_commit, which clears _changes
+    @classmethod
+    def after_commit(cls, session):
+        follow_changes = getattr(session, '_follow_changes', None)
+        session._follow_changes = []
+        current_app.follow_graph.apply(follow_changes)
+        if not session._changes:
+            return
+        current_app.user_cache.invalidate([
+            db.inspect(obj).identity[0]
+            for obj in session._changes['update'] + session._changes['delete']
+            if isinstance(obj, User)])
+
 
 class Post(SearchableMixin, db.Model):
     __searchable__ = ['body']
+    # Composite indexes back keyset pagination on (timestamp, id)
+    __table_args__ = (
+        db.Index('ix_post_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_post_user_id_timestamp_id', 'user_id', 'timestamp', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
-    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     language = db.Column(db.String(5))
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
+    # Searchable body plus the stored fields search results render from
+    # Authors are stored with their avatar digest, never their email
+    def search_document(self):
+        author = self.author
+        return Post.document(self.body, self.timestamp, self.language,
+                             self.user_id, author and author.username,
+                             author and author.email, author and author.revision)
+
+    @staticmethod
+    def document(body, timestamp, language, user_id, username, email, revision):
+        return {'body': body, 'stored': {
+            'timestamp': timestamp.isoformat() if timestamp else None,
+            'language': language, 'user_id': user_id,
+            'author': {'username': username,
+                       'avatar': email and avatar_digest(email),
+                       'revision': revision or 0}}}
+
+    # (id, document) pairs for posts matching where, in id order, read with
+    # Core on conn
+    @classmethod
+    def documents(cls, conn, where, limit=None):
+        post, user = cls.__table__, User.__table__
+        rows = conn.execute(db.select([
+            post.c.id, post.c.body, post.c.timestamp, post.c.language,
+            post.c.user_id, user.c.username, user.c.email, user.c.revision,
+        ]).select_from(post.outerjoin(user, post.c.user_id == user.c.id)).where(
+            where).order_by(post.c.id).limit(limit))
+        return [(row[0], cls.document(*row[1:])) for row in rows]
+
+    # Rewrites the stored author fields of every post by a user
+    @classmethod
+    def reindex_author(cls, user_id, chunk_size=1000):
+        last_id = 0
+        while True:
+            with db.engine.connect() as conn:
+                chunk = cls.documents(conn, db.and_(
+                    cls.user_id == user_id, cls.id > last_id), chunk_size)
+            if not chunk:
+                return
+            for id, payload in chunk:
+                add_to_index(cls.__tablename__, id, payload)
+            last_id = chunk[-1][0]
+
+    # Fan-out on write: push newly flushed posts into the author's timeline
+    # and the timelines of their followers, inside the same transaction
+    # New posts and authors whose revision changed are also staged on the
+    # session for the after_commit hook, and changes to what existing posts
+    # render bump the content version
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        cls.update_posts_count(session)
+        if not getattr(session, '_changed_authors', None):
+            session._changed_authors = set()
+        changed_authors = {
+            obj.id for obj in session.dirty if isinstance(obj, User) and
+            any(db.inspect(obj).attrs[key].history.has_changes()
+                for key in User.REVISION_FIELDS)}
+        session._changed_authors.update(changed_authors)
+        if changed_authors or any(isinstance(obj, Post) for obj in session.deleted) \
+                or any(isinstance(obj, Post) and session.is_modified(obj)
+                       for obj in session.dirty):
+            bump_content_version(session.connection())
+        new_posts = [obj for obj in session.new if isinstance(obj, Post)]
+        if not new_posts:
+            return
+        if not getattr(session, '_new_posts', None):
+            session._new_posts = []
+        session._new_posts.extend(dict(
+            id=obj.id, user_id=obj.user_id, body=obj.body,
+            timestamp=obj.timestamp, language=obj.language) for obj in new_posts)
+        ids = [obj.id for obj in new_posts]
+        new_posts = db.select([cls.id, cls.user_id, cls.timestamp]).where(
+            cls.id.in_(ids)).alias()
+        to_followers = db.select(
+            [followers.c.follower_id, new_posts.c.id, new_posts.c.timestamp]).where(
+                db.and_(followers.c.followed_id == new_posts.c.user_id,
+                        db.exists().where(
+                            timeline_built.c.user_id == followers.c.follower_id)))
+        to_author = db.select(
+            [new_posts.c.user_id, new_posts.c.id, new_posts.c.timestamp]).where(
+                db.exists().where(timeline_built.c.user_id == new_posts.c.user_id))
+        session.connection().execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'], db.union(to_followers, to_author)))
+
+    # Timeline rows of deleted posts go first, as they reference the posts
+    @classmethod
+    def before_flush(cls, session, flush_context, instances):
+        ids = [obj.id for obj in session.deleted if isinstance(obj, Post)]
+        if ids:
+            session.connection().execute(
+                timeline.delete().where(timeline.c.post_id.in_(ids)))
+
+    # Applies posts_count deltas for flushed inserts and deletes in one
+    # UPDATE per author, inside the flush's transaction
+    @classmethod
+    def update_posts_count(cls, session):
+        deltas = {}
+        for obj in session.new:
+            if isinstance(obj, Post):
+                deltas[obj.user_id] = deltas.get(obj.user_id, 0) + 1
+        for obj in session.deleted:
+            if isinstance(obj, Post):
+                deltas[obj.user_id] = deltas.get(obj.user_id, 0) - 1
+        user = User.__table__
+        for user_id, delta in deltas.items():
+            if user_id is None or delta == 0:
+                continue
+            session.connection().execute(user.update().where(
+                user.c.id == user_id).values(
+                    posts_count=db.func.coalesce(user.c.posts_count, 0) + delta))
+            author = session.identity_map.get(identity_key(User, user_id))
+            if author is not None:
+                session.expire(author, ['posts_count'])
+
+    # Post-creation commit hook: hands committed posts to background services
+    # and publishes them to followers' streams
+    # Also drops cached renderings of posts changed by the commit, refreshes
+    # them (and changed authors) in the recent posts window, and rewrites the
+    # stored author fields of renamed users' posts in the search index
+    # Registered ahead of SearchableMixin.after_commit, which clears _changes
+    @classmethod
+    def after_commit(cls, session):
+        new_posts = getattr(session, '_new_posts', None) or []
+        author_ids = getattr(session, '_changed_authors', None) or ()
+        session._changed_authors = set()
+        current_app.recent_posts.add(new_posts)
+        current_app.post_bus.publish(new_posts)
+        changes = session._changes or {'update': [], 'delete': []}
+        post_ids = []
+        for obj in changes['update'] + changes['delete']:
+            if isinstance(obj, Post):
+                current_app.fragment_cache.invalidate_post(obj.id)
+                post_ids.append(obj.id)
+        current_app.recent_posts.refresh(post_ids, author_ids)
+        for user_id in author_ids:
+            cls.reindex_author(user_id)
+
+    # Registered after SearchableMixin.after_commit, so the documents the
+    # language detector indexes replace the ones queued by the commit
+    # Posts are counted for trending terms once their language is known
+    @classmethod
+    def submit_languages(cls, session):
+        new_posts = getattr(session, '_new_posts', None) or []
+        session._new_posts = []
+        current_app.trending.add([post for post in new_posts
+                                  if post['language'] is not None])
+        for post in new_posts:
+            if post['language'] is None:
+                current_app.language_detector.submit(post['id'], post['body'])
+
+    # Posts and follows flushed in a rolled back transaction never existed
+    @classmethod
+    def after_rollback(cls, session):
+        session._new_posts = []
+        session._changed_authors = set()
+        session._follow_changes = []
+
+
+db.event.listen(db.session, 'before_flush', Post.before_flush)
+db.event.listen(db.session, 'after_flush', Post.after_flush)
+db.event.listen(db.session, 'after_flush', User.after_flush)
+db.event.listen(db.session, 'after_commit', Post.after_commit, insert=True)
+db.event.listen(db.session, 'after_commit', User.after_commit, insert=True)
+db.event.listen(db.session, 'after_commit', Post.submit_languages)
+db.event.listen(db.session, 'after_rollback', Post.after_rollback)
+
+
+# Recomputes every user's counters from the source tables
+def recompute_counters():
+    user = User.__table__
+    db.session.execute(user.update().values(
+        followers_count=db.select([db.func.count()]).where(
+            followers.c.followed_id == user.c.id).as_scalar(),
+        followed_count=db.select([db.func.count()]).where(
+            followers.c.follower_id == user.c.id).as_scalar(),
+        posts_count=db.select([db.func.count()]).where(
+            Post.user_id == user.c.id).as_scalar()))
+
 
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    return current_app.user_cache.load(int(id))
@@ -0,0 +1,92 @@
+import base64
+import binascii
+from datetime import datetime
+
+from app import db
+
+
+# Keyset (cursor) pagination over (timestamp, id) in descending order
+# Cursors are opaque urlsafe strings holding a direction and the key of the
+# row at the page edge, so every page is an index range scan with no OFFSET
+# and no COUNT(*)
+class KeysetPage(object):
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def encode_cursor(timestamp, id, direction='next'):
+    raw = '{}|{}|{}'.format(direction[0], timestamp.isoformat(), id)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+# Returns (timestamp, id, direction) or None if the cursor is malformed
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+        direction, timestamp, id = raw.split('|')
+        if direction not in ('n', 'p'):
+            return None
+        return (datetime.fromisoformat(timestamp), int(id),
+                'next' if direction == 'n' else 'prev')
+    except (ValueError, UnicodeError, binascii.Error):
+        return None
+
+
+# timestamp_col/id_col are the columns the query is ordered by, which must be
+# covered by a composite index for the range scan to stay cheap
+def paginate_keyset(query, timestamp_col, id_col, cursor, per_page):
+    key = decode_cursor(cursor)
+    query = query.order_by(None)
+    if key is None:
+        rows = query.order_by(timestamp_col.desc(), id_col.desc()).limit(
+            per_page + 1).all()
+        has_next, has_prev = len(rows) > per_page, False
+        rows = rows[:per_page]
+    else:
+        timestamp, id, direction = key
+        if direction == 'next':
+            rows = query.filter(db.or_(
+                timestamp_col < timestamp,
+                db.and_(timestamp_col == timestamp, id_col < id))).order_by(
+                    timestamp_col.desc(), id_col.desc()).limit(per_page + 1).all()
+            has_next, has_prev = len(rows) > per_page, True
+            rows = rows[:per_page]
+        else:
+            rows = query.filter(db.or_(
+                timestamp_col > timestamp,
+                db.and_(timestamp_col == timestamp, id_col > id))).order_by(
+                    timestamp_col.asc(), id_col.asc()).limit(per_page + 1).all()
+            has_next, has_prev = True, len(rows) > per_page
+            rows = list(reversed(rows[:per_page]))
+    return make_page(rows, has_next, has_prev)
+
+
+# Builds the page for rows already in descending order, with cursors on the
+# rows at its edges
+def make_page(rows, has_next, has_prev):
+    next_cursor = encode_cursor(rows[-1].timestamp, rows[-1].id, 'next') \
+        if rows and has_next else None
+    prev_cursor = encode_cursor(rows[0].timestamp, rows[0].id, 'prev') \
+        if rows and has_prev else None
+    return KeysetPage(rows, next_cursor, prev_cursor)
+
+
+# (timestamp, id) of the newest row of query, or None if it is empty
+# Only the key columns are selected, so with a composite index on them this
+# is an index-only lookup of a single entry
+def latest_key(query, timestamp_col, id_col):
+    return query.with_entities(timestamp_col, id_col).order_by(None).order_by(
+        timestamp_col.desc(), id_col.desc()).first()
@@ -0,0 +1,147 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+
+from flask import current_app
+from guess_language import guess_language
+
+from app import db
+from app.models import Post, bump_content_version
+from app.recent import AuthorSnapshot, PostSnapshot
+from app.search import index_version, search_index
+
+
+# Shared post-creation service used by every view that publishes a post
+# Language detection is left to Post.submit_languages, which hands the new
+# post to the LanguageDetector so it stays off the submit latency path
+def create_post(author, body):
+    post = Post(body=body, author=author.attached())
+    db.session.add(post)
+    db.session.commit()
+    return post
+
+
+# Search results rendered from the stored fields of index documents, with
+# no second query to load (and re-order) the matching posts
+# Pages are cached by (query, page, index version); hits indexed before
+# documents had stored fields (or stored the avatar digest) are loaded from
+# the database, and pages holding such session-bound objects aren't cached
+def search_posts(query, page, per_page):
+    key = (query, page, per_page, index_version())
+    result = current_app.search_cache.get(key)
+    if result is not None:
+        return result
+    hits, total = search_index(Post.__tablename__, query, page, per_page,
+                               Post.__searchable__)
+    missing = [id for id, document in hits if not _stored(document)]
+    loaded = {post.id: post for post in Post.query.filter(Post.id.in_(missing))} \
+        if missing else {}
+    posts = [loaded[id] if id in loaded else _snapshot(id, document)
+             for id, document in hits if id in loaded or id not in missing]
+    result = (posts, total)
+    if not missing:
+        current_app.search_cache.set(key, result)
+    return result
+
+
+def _stored(document):
+    stored = (document or {}).get('stored')
+    return stored is not None and 'avatar' in stored['author']
+
+
+def _snapshot(id, document):
+    stored = document['stored']
+    author = stored['author']
+    return PostSnapshot(
+        id=id, body=document['body'],
+        timestamp=datetime.fromisoformat(stored['timestamp']),
+        language=stored['language'], user_id=stored['user_id'],
+        author=AuthorSnapshot.from_digest(stored['user_id'], author['username'],
+                                          author['avatar'], author['revision']))
+
+
+# Near-duplicate bodies (case, spacing, punctuation, digits) share a cache entry
+def normalize(body):
+    return ' '.join(re.sub(r'[\W\d_]+', ' ', body.lower()).split())
+
+
+@lru_cache(maxsize=8192)
+def _detect(normalized):
+    language = guess_language(normalized)
+    if language == 'UNKNOWN' or len(language) > 5:
+        language = ''
+    return language
+
+
+def detect_language(body):
+    return _detect(normalize(body or ''))
+
+
+# Fills Post.language after commit from a small thread pool
+# With LANGUAGE_DETECTION_ASYNC off (e.g. in tests) it runs inline
+class LanguageDetector(object):
+    def __init__(self, app):
+        self.app = app
+        self.async_mode = app.config.get('LANGUAGE_DETECTION_ASYNC', True)
+        self._executor = ThreadPoolExecutor(
+            max_workers=app.config.get('LANGUAGE_DETECTION_WORKERS', 2))
+
+    def submit(self, post_id, body):
+        if self.async_mode:
+            self._executor.submit(self._fill, post_id, body)
+        else:
+            self._fill(post_id, body)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def _fill(self, post_id, body):
+        try:
+            language = detect_language(body)
+            # Core UPDATE, so the session's commit hooks don't run again
+            with db.get_engine(self.app).begin() as conn:
+                conn.execute(Post.__table__.update().where(db.and_(
+                    Post.id == post_id, Post.language.is_(None))).values(
+                        language=language))
+                # The "Translate" link depends on the language
+                bump_content_version(conn)
+                documents = Post.documents(conn, Post.id == post_id)
+            # Other processes drop their copies through the fragment cache's
+            # channel (or miss them, as the language is part of the key) and
+            # the recent posts window through Redis (or the content version)
+            self.app.fragment_cache.invalidate_post(post_id)
+            self.app.recent_posts.set_language(post_id, language)
+            self.app.trending.add([{'body': body, 'language': language}])
+            # The search index stores the language for rendering results
+            if self.app.search_queue:
+                for id, payload in documents:
+                    self.app.search_queue.add(Post.__tablename__, id, payload)
+        except Exception:
+            self.app.logger.exception('Language detection failed for post %s',
+                                      post_id)
+
+
+# Backfills languages for posts that have none, in id-ordered batches whose
+# bodies are classified in parallel by a process pool
+def backfill_languages(pool, batch_size=1000):
+    post = Post.__table__
+    last_id, updated = 0, 0
+    while True:
+        with db.engine.connect() as conn:
+            rows = conn.execute(db.select([post.c.id, post.c.body]).where(db.and_(
+                post.c.id > last_id, post.c.language.is_(None))).order_by(
+                    post.c.id).limit(batch_size)).fetchall()
+        if not rows:
+            return updated
+        languages = pool.map(detect_language, [row.body for row in rows],
+                             chunksize=max(1, batch_size // 16))
+        with db.engine.begin() as conn:
+            conn.execute(
+                post.update().where(post.c.id == db.bindparam('post_id')).values(
+                    language=db.bindparam('detected')),
+                [{'post_id': row.id, 'detected': language}
+                 for row, language in zip(rows, languages)])
+            bump_content_version(conn)
+        last_id = rows[-1].id
+        updated += len(rows)
@@ -0,0 +1,375 @@
+import bisect
+import json
+import threading
+import time
+from datetime import datetime
+
+from app import db
+from app.models import Post, User, avatar_digest, avatar_prefix, \
+    content_version
+from app.pagination import decode_cursor, make_page
+
+
+# Stand-ins for User/Post rendered by _post.html from the recent posts window
+class AuthorSnapshot(object):
+    # Shares User's memoized Gravatar URL
+    avatar = User.avatar
+    _avatar_email = None
+    _avatar_prefix = None
+
+    def __init__(self, id, username, email, revision):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.revision = revision
+
+    # Author of a search document, which has the avatar digest but no email
+    @classmethod
+    def from_digest(cls, id, username, digest, revision):
+        author = cls(id, username, None, revision)
+        if digest is not None:
+            author._avatar_prefix = avatar_prefix(digest)
+        return author
+
+
+class PostSnapshot(object):
+    def __init__(self, id, body, timestamp, language, user_id, author):
+        self.id = id
+        self.body = body
+        self.timestamp = timestamp
+        self.language = language
+        self.user_id = user_id
+        self.author = author
+
+
+# The newest posts by (timestamp, id), as plain dicts
+# Authors are kept with their avatar digest, never their email
+# Holds every post with a key at or above its oldest one (or every post,
+# when complete), so any page falling inside it can be cut from it exactly
+class _Window(object):
+    def __init__(self, capacity, posts, authors, complete):
+        self.capacity = capacity
+        self.posts = {post['id']: post for post in posts}
+        self.authors = {author['id']: author for author in authors}
+        self.keys = sorted((post['timestamp'], post['id']) for post in posts)
+        self.complete = complete
+
+    # Returns False if the post is older than the window and was dropped
+    def insert(self, post):
+        self.remove(post['id'])
+        key = (post['timestamp'], post['id'])
+        if not self.complete and (not self.keys or key < self.keys[0]):
+            return False
+        bisect.insort(self.keys, key)
+        self.posts[post['id']] = post
+        while len(self.keys) > self.capacity:
+            self.posts.pop(self.keys.pop(0)[1])
+            self.complete = False
+        return True
+
+    # Drops authors with no posts left in the window
+    def prune_authors(self):
+        user_ids = {post['user_id'] for post in self.posts.values()}
+        for user_id in list(self.authors):
+            if user_id not in user_ids:
+                del self.authors[user_id]
+
+    def remove(self, id):
+        post = self.posts.pop(id, None)
+        if post is not None:
+            self.keys.remove((post['timestamp'], id))
+
+    # (keys, has_next, has_prev) for the page after/before key, like
+    # paginate_keyset, or None if the page reaches past the window
+    def page(self, key, per_page):
+        keys = self.keys
+        if key is None:
+            rows = keys[-per_page - 1:][::-1]
+            if len(rows) <= per_page and not self.complete:
+                return None
+            return rows[:per_page], len(rows) > per_page, False
+        timestamp, id, direction = key
+        if not self.complete and (not keys or (timestamp, id) < keys[0]):
+            return None
+        if direction == 'next':
+            end = bisect.bisect_left(keys, (timestamp, id))
+            rows = keys[max(0, end - per_page - 1):end][::-1]
+            if len(rows) <= per_page and not self.complete:
+                return None
+            return rows[:per_page], len(rows) > per_page, True
+        start = bisect.bisect_right(keys, (timestamp, id))
+        rows = keys[start:start + per_page + 1]
+        return rows[:per_page][::-1], True, len(rows) > per_page
+
+    def snapshot(self, id):
+        post = self.posts[id]
+        author = self.authors.get(post['user_id'])
+        return PostSnapshot(author=author and AuthorSnapshot.from_digest(
+            author['id'], author['username'], author['avatar'],
+            author['revision']), **post)
+
+    def to_json(self):
+        return json.dumps({
+            'posts': [dict(post, timestamp=post['timestamp'].isoformat())
+                      for post in self.posts.values()],
+            'authors': list(self.authors.values()),
+            'complete': self.complete})
+
+    @classmethod
+    def from_json(cls, capacity, raw):
+        data = json.loads(raw)
+        for post in data['posts']:
+            post['timestamp'] = datetime.fromisoformat(post['timestamp'])
+        return cls(capacity, data['posts'], data['authors'], data['complete'])
+
+
+# Window of the newest RECENT_POSTS_PAGES pages of posts, so the posts of
+# the first pages of explore are cut from memory instead of queried; deeper
+# pages fall back to SQL
+# Loaded by preload() before the first request (and again whenever it was
+# dropped) and kept current by Post.after_commit (new, edited and deleted
+# posts, author profile changes) and the language detector
+# The window is per process unless REDIS_URL is configured, in which case
+# it is shared through Redis and updated with optimistic transactions
+# A per-process window can't see commits made by other processes (or CLI
+# commands), so every RECENT_POSTS_REVALIDATE seconds it is checked against
+# the newest post key and the content version, and reloaded if either moved;
+# that check (two indexed lookups) is the only SQL the window itself runs
+# between loads
+class RecentPosts(object):
+    # Versioned since authors stopped carrying emails
+    key = 'recent_posts:2'
+
+    def __init__(self, app):
+        self.app = app
+        self.capacity = app.config.get('RECENT_POSTS_PAGES', 3) * \
+            app.config.get('POSTS_PER_PAGE', 25) + 1
+        self.enabled = self.capacity > 1
+        self.revalidate_interval = app.config.get('RECENT_POSTS_REVALIDATE', 2)
+        self.redis = app.redis
+        self._window = None
+        self._stamp = None
+        self._checked = 0
+        self._parsed = (None, None)
+        self._lock = threading.Lock()
+
+    # Loads the window ahead of the first explore request
+    def preload(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._read()
+
+    # Same page paginate_keyset would return for the newest posts query, or
+    # None if it isn't (entirely) inside the window
+    def paginate(self, cursor, per_page):
+        if not self.enabled:
+            return None
+        key = decode_cursor(cursor)
+        if cursor and key is None:
+            return None
+        self._revalidate()
+        with self._lock:
+            window = self._read()
+            page = window.page(key, per_page)
+            if page is None:
+                return None
+            keys, has_next, has_prev = page
+            rows = [window.snapshot(id) for _, id in keys]
+        return make_page(rows, has_next, has_prev)
+
+    # (timestamp, id) of the newest post, or None if unknown
+    def latest(self):
+        if not self.enabled:
+            return None
+        self._revalidate()
+        with self._lock:
+            window = self._read()
+            return window.keys[-1] if window.keys else None
+
+    # Adds committed posts (dicts staged by Post.after_flush)
+    def add(self, posts):
+        if not self.enabled or not posts:
+            return
+        posts = [{field: post[field] for field in
+                  ('id', 'body', 'timestamp', 'language', 'user_id')}
+                 for post in posts]
+        window = self._peek()
+        if window is None:
+            return
+        authors = self._load_authors({post['user_id'] for post in posts
+                                      if post['user_id'] not in window.authors})
+
+        def insert(window):
+            window.authors.update(authors)
+            for post in posts:
+                if window.insert(post) and post['user_id'] not in window.authors:
+                    # Author pruned since it was looked up
+                    return False
+            return True
+        self._update(insert)
+
+    # Reloads posts and authors changed by a commit, if they are in the window
+    def refresh(self, post_ids, author_ids):
+        if not self.enabled or not (post_ids or author_ids):
+            return
+        window = self._peek()
+        if window is None:
+            return
+        post_ids = [id for id in post_ids if id in window.posts]
+        author_ids = {id for id in author_ids if id in window.authors}
+        if not (post_ids or author_ids):
+            return
+        posts = self._load_posts(post_ids)
+        authors = self._load_authors(author_ids)
+
+        def replace(window):
+            window.authors.update(authors)
+            for id in post_ids:
+                if id in posts:
+                    window.insert(posts[id])
+                else:
+                    window.remove(id)
+            return True
+        self._update(replace)
+
+    def set_language(self, post_id, language):
+        if not self.enabled:
+            return
+
+        def fill(window):
+            if post_id in window.posts:
+                window.posts[post_id]['language'] = language
+            return True
+        self._update(fill)
+
+    def clear(self):
+        with self._lock:
+            self._window = None
+            self._parsed = (None, None)
+        if self.redis is not None:
+            self.redis.delete(self.key)
+
+    # Drops a per-process window that no longer matches the database
+    def _revalidate(self):
+        if self.redis is not None or \
+                time.time() - self._checked < self.revalidate_interval:
+            return
+        stamp = self._current_stamp()
+        with self._lock:
+            if self._window is not None and stamp != self._stamp:
+                self._window = None
+
+    # Current window, loading it if needed (caller holds the lock)
+    def _read(self):
+        if self.redis is None:
+            if self._window is None:
+                self._stamp = self._current_stamp()
+                self._window = self._load()
+            return self._window
+        raw = self.redis.get(self.key)
+        if raw is None:
+            window = self._load()
+            raw = window.to_json().encode('utf-8')
+            self.redis.set(self.key, raw, nx=True)
+        if self._parsed[0] != raw:
+            self._parsed = (raw, _Window.from_json(self.capacity, raw))
+        return self._parsed[1]
+
+    # Current window without loading it, or None
+    # Waits for a load in progress, which may predate the caller's commit
+    def _peek(self):
+        if self.redis is None:
+            with self._lock:
+                return self._window
+        raw = self.redis.get(self.key)
+        return _Window.from_json(self.capacity, raw) if raw else None
+
+    # Applies change(window) to the loaded window; a False result discards
+    # the window so it is reloaded on next use
+    def _update(self, change):
+        if self.redis is None:
+            with self._lock:
+                if self._window is not None:
+                    if change(self._window):
+                        self._window.prune_authors()
+                    else:
+                        self._window = None
+            return
+        from redis.exceptions import WatchError
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self.key)
+                    raw = pipe.get(self.key)
+                    if raw is None:
+                        return
+                    window = _Window.from_json(self.capacity, raw)
+                    keep = change(window)
+                    pipe.multi()
+                    if keep:
+                        window.prune_authors()
+                        pipe.set(self.key, window.to_json())
+                    else:
+                        pipe.delete(self.key)
+                    pipe.execute()
+                    return
+                except WatchError:
+                    continue
+
+    # (newest post key, content version), read before a load so that
+    # commits racing with the load cause another one
+    def _current_stamp(self):
+        post = Post.__table__
+        with db.get_engine(self.app).connect() as conn:
+            latest = conn.execute(db.select([post.c.timestamp, post.c.id]).order_by(
+                post.c.timestamp.desc(), post.c.id.desc()).limit(1)).first()
+            version = conn.execute(db.select([content_version.c.version]).where(
+                content_version.c.id == 1)).scalar()
+        self._checked = time.time()
+        return tuple(latest) if latest else None, version
+
+    # Reads go to the primary engine, outside the request's session
+    def _load(self):
+        post, user = Post.__table__, User.__table__
+        with db.get_engine(self.app).connect() as conn:
+            rows = conn.execute(db.select([
+                post.c.id, post.c.body, post.c.timestamp, post.c.language,
+                post.c.user_id, user.c.username, user.c.email, user.c.revision,
+            ]).select_from(post.outerjoin(user, post.c.user_id == user.c.id)).order_by(
+                post.c.timestamp.desc(), post.c.id.desc()).limit(
+                    self.capacity)).fetchall()
+        posts = [dict(id=row.id, body=row.body, timestamp=row.timestamp,
+                      language=row.language, user_id=row.user_id)
+                 for row in rows]
+        authors = {row.user_id: _author(row.user_id, row.username, row.email,
+                                        row.revision)
+                   for row in rows if row.username is not None}
+        return _Window(self.capacity, posts, authors.values(),
+                       len(rows) < self.capacity)
+
+    def _load_posts(self, ids):
+        if not ids:
+            return {}
+        post = Post.__table__
+        with db.get_engine(self.app).connect() as conn:
+            rows = conn.execute(db.select([
+                post.c.id, post.c.body, post.c.timestamp, post.c.language,
+                post.c.user_id]).where(post.c.id.in_(ids))).fetchall()
+        return {row.id: dict(row) for row in rows}
+
+    def _load_authors(self, ids):
+        ids = [id for id in ids if id is not None]
+        if not ids:
+            return {}
+        user = User.__table__
+        with db.get_engine(self.app).connect() as conn:
+            rows = conn.execute(db.select([
+                user.c.id, user.c.username, user.c.email, user.c.revision]).where(
+                    user.c.id.in_(ids))).fetchall()
+        return {row.id: _author(*row) for row in rows}
+
+
+def _author(id, username, email, revision):
+    return dict(id=id, username=username,
+                avatar=email and avatar_digest(email), revision=revision)
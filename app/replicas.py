@@ -0,0 +1,81 @@
+import random
+import time
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import orm
+from sqlalchemy.sql.expression import UpdateBase
+
+
+# Session that sends reads made while serving a GET/HEAD request to the
+# replica picked for that request, and everything else to the primary
+# A flush or an INSERT/UPDATE/DELETE statement marks the request as writing,
+# after which it stays on the primary so it reads its own writes
+# Raw text() statements can't be told apart, so writes that aren't ORM
+# flushes or Core DML constructs should go through db.engine
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if has_request_context():
+            if self._flushing or isinstance(clause, UpdateBase):
+                g.db_wrote = True
+            elif g.get('db_replica') and not g.get('db_wrote') and \
+                    _bind_key(mapper) is None:
+                return get_state(self.app).db.get_engine(
+                    self.app, bind=g.db_replica)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+# Keeps the rest of the request on the primary after a write made outside
+# the session, e.g. through db.engine
+def wrote():
+    if has_request_context():
+        g.db_wrote = True
+
+
+def _bind_key(mapper):
+    if mapper is None:
+        return None
+    return mapper.persist_selectable.info.get('bind_key')
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+# Registers each URL in SQLALCHEMY_REPLICAS as a 'replica_<n>' bind and the
+# request hooks that route reads to them
+# Each GET/HEAD request reads from one replica, picked at random, unless
+# the client wrote in the last DATABASE_REPLICA_STICKY seconds (tracked in
+# the session cookie), so a redirect after a POST sees the new rows even if
+# replication is lagging
+def init_app(app):
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    app.db_replicas = []
+    for i, url in enumerate(app.config.get('SQLALCHEMY_REPLICAS') or []):
+        key = 'replica_{}'.format(i)
+        binds[key] = url
+        app.db_replicas.append(key)
+    app.config['SQLALCHEMY_BINDS'] = binds or None
+    if not app.db_replicas:
+        return
+    sticky = app.config.get('DATABASE_REPLICA_STICKY', 5)
+
+    @app.before_request
+    def choose_replica():
+        g.db_wrote = False
+        g.db_replica = None
+        if request.method in ('GET', 'HEAD') and \
+                session.get('_db_primary_until', 0) < time.time():
+            g.db_replica = random.choice(app.db_replicas)
+
+    @app.after_request
+    def remember_write(response):
+        if g.get('db_wrote'):
+            session['_db_primary_until'] = time.time() + sticky
+        return response
+
+    @app.teardown_request
+    def reset_replica(exc):
+        g.pop('db_replica', None)
+        g.pop('db_wrote', None)
@@ -1,29 +1,379 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
 from flask import current_app
 
+from app.instrumentation import timed
+
+
+# Background queue that batches index changes into backend bulk requests
+# Changes are keyed by (index, id), so repeated updates to the same object
+# between batches collapse into the latest one
+# With SEARCH_ASYNC off (e.g. in tests) changes are applied immediately
+class IndexingQueue(object):
+    def __init__(self, app, backend):
+        self.backend = backend
+        self.logger = app.logger
+        self.async_mode = app.config.get('SEARCH_ASYNC', True)
+        self.batch_size = app.config.get('SEARCH_BATCH_SIZE', 500)
+        self.flush_interval = app.config.get('SEARCH_FLUSH_INTERVAL', 1.0)
+        self.max_retries = app.config.get('SEARCH_MAX_RETRIES', 5)
+        self.retry_backoff = app.config.get('SEARCH_RETRY_BACKOFF', 0.5)
+        self.redis = app.redis
+        self._version = 0
+        self._pending = OrderedDict()
+        self._in_flight = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def add(self, index, id, payload):
+        self._put((index, id), payload)
+
+    def remove(self, index, id):
+        self._put((index, id), None)
+
+    def _put(self, key, payload):
+        if not self.async_mode:
+            self._send([(key, payload)])
+            return
+        with self._cond:
+            # Re-inserting moves the key to the end so batches keep commit order
+            self._pending.pop(key, None)
+            self._pending[key] = payload
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+
+    # Blocks until everything queued so far has been sent (or given up on)
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._pending or self._in_flight:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    # Changes whenever a batch reaches the index (in any worker process
+    # sharing REDIS_URL), for versioning cached results
+    def version(self):
+        if self.redis is not None:
+            return int(self.redis.get('search:version') or 0)
+        return self._version
+
+    def close(self, timeout=None):
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _take_batch(self):
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            if len(self._pending) < self.batch_size and not self._closed:
+                # Give more changes a chance to accumulate into this batch
+                self._cond.wait(self.flush_interval)
+            batch = []
+            while self._pending and len(batch) < self.batch_size:
+                batch.append(self._pending.popitem(last=False))
+            self._in_flight = len(batch)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+            try:
+                self._send(batch)
+            finally:
+                with self._cond:
+                    self._in_flight = 0
+                    self._cond.notify_all()
+
+    def _send(self, batch):
+        for attempt in range(self.max_retries + 1):
+            try:
+                errors = self.backend.bulk(batch)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    self.logger.error('Dropping %d search index changes: %s',
+                                      len(batch), e)
+                    return
+                time.sleep(self.retry_backoff * 2 ** attempt)
+            else:
+                if errors:
+                    self.logger.error('Search indexing errors: %s', errors[:10])
+                self._version += 1
+                if self.redis is not None:
+                    self.redis.incr('search:version')
+                return
+
+
+# Interface for search engines behind add_to_index/query_index
+# bulk() takes [((index, id), payload or None for delete)] and returns a list
+# of per-item errors; transport failures raise so the queue can retry
+# Backends missing a method fail when constructed, not on first use
+class SearchBackend(ABC):
+    @abstractmethod
+    def bulk(self, changes):
+        pass
+
+    # Ids of objects matching query in fields, and the total
+    @abstractmethod
+    def query(self, index, query, page, per_page, fields):
+        pass
+
+    # Like query(), but returns [(id, stored document)] hits, with a total
+    # that is only exact up to track_total
+    @abstractmethod
+    def search(self, index, query, page, per_page, fields, track_total):
+        pass
+
+
+class ElasticsearchBackend(SearchBackend):
+    def __init__(self, client):
+        self.client = client
+
+    def bulk(self, changes):
+        body = []
+        for (index, id), payload in changes:
+            if payload is None:
+                body.append({'delete': {'_index': index, '_id': id}})
+            else:
+                body.append({'index': {'_index': index, '_id': id}})
+                body.append(payload)
+        response = self.client.bulk(body=body)
+        if not response.get('errors'):
+            return []
+        # Deleting an object that was never indexed is not a failure
+        return [item for item in response['items']
+                for op, result in item.items()
+                if result.get('status', 200) >= 300 and
+                not (op == 'delete' and result['status'] == 404)]
+
+    def query(self, index, query, page, per_page, fields):
+        search = self.client.search(
+            index=index,
+            body={'query': {'multi_match': {'query': query, 'fields': fields}},
+                  'from': (page - 1) * per_page, 'size': per_page})
+        ids = [int(hit['_id']) for hit in search['hits']['hits']]
+        return ids, search['hits']['total']['value']
+
+    def search(self, index, query, page, per_page, fields, track_total):
+        search = self.client.search(
+            index=index,
+            body={'query': {'multi_match': {'query': query, 'fields': fields}},
+                  'from': (page - 1) * per_page, 'size': per_page,
+                  'track_total_hits': track_total})
+        hits = [(int(hit['_id']), hit.get('_source'))
+                for hit in search['hits']['hits']]
+        return hits, search['hits']['total']['value']
+
+
+# Embedded engine on SQLite FTS5, one virtual table per index
+# Rows are keyed by rowid = object id, so updates and deletes are point
+# operations, and results are ranked with FTS5's built-in BM25
+class SQLiteSearchBackend(SearchBackend):
+    def __init__(self, path):
+        self._local = threading.local()
+        self._tables = set()
+        self._lock = threading.Lock()
+        self._keeper = None
+        if path is None or path == ':memory:':
+            # Named shared-cache database so every thread sees the same index,
+            # held open for the lifetime of the backend
+            self.uri = 'file:search-{}?mode=memory&cache=shared'.format(id(self))
+            self._keeper = self._connection()
+        else:
+            self.uri = 'file:{}'.format(os.path.abspath(path))
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _table(self, conn, index):
+        if not re.match(r'^\w+$', index):
+            raise ValueError('Invalid index name: {}'.format(index))
+        name = 'fts_' + index
+        if name not in self._tables:
+            with self._lock:
+                conn.execute(
+                    'CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5('
+                    'content, document UNINDEXED, '
+                    "tokenize='unicode61 remove_diacritics 2')".format(name))
+                self._tables.add(name)
+        return name
+
+    def bulk(self, changes):
+        conn = self._connection()
+        with conn:
+            for (index, id), payload in changes:
+                table = self._table(conn, index)
+                conn.execute('DELETE FROM {} WHERE rowid = ?'.format(table), (id,))
+                if payload is not None:
+                    # Nested stored fields are kept in document only
+                    content = ' '.join(str(value) for value in payload.values()
+                                       if isinstance(value, str))
+                    conn.execute(
+                        'INSERT INTO {} (rowid, content, document) '
+                        'VALUES (?, ?, ?)'.format(table),
+                        (id, content, json.dumps(payload, default=str)))
+        return []
+
+    # Only the searchable fields make up the content column, so fields is
+    # implied
+    def query(self, index, query, page, per_page, fields):
+        match = self._match(query)
+        if match is None:
+            return [], 0
+        conn = self._connection()
+        table = self._table(conn, index)
+        ids = [row[0] for row in conn.execute(
+            'SELECT rowid FROM {0} WHERE {0} MATCH ? ORDER BY bm25({0}) '
+            'LIMIT ? OFFSET ?'.format(table),
+            (match, per_page, (page - 1) * per_page))]
+        total = conn.execute('SELECT count(*) FROM {0} WHERE {0} MATCH ?'.format(
+            table), (match,)).fetchone()[0]
+        return ids, total
+
+    # Only the searchable fields make up the content column, so fields is
+    # implied; counting stops at track_total matches
+    def search(self, index, query, page, per_page, fields, track_total):
+        match = self._match(query)
+        if match is None:
+            return [], 0
+        conn = self._connection()
+        table = self._table(conn, index)
+        hits = [(row[0], json.loads(row[1])) for row in conn.execute(
+            'SELECT rowid, document FROM {0} WHERE {0} MATCH ? '
+            'ORDER BY bm25({0}) LIMIT ? OFFSET ?'.format(table),
+            (match, per_page, (page - 1) * per_page))]
+        total = conn.execute(
+            'SELECT count(*) FROM (SELECT 1 FROM {0} WHERE {0} MATCH ? '
+            'LIMIT ?)'.format(table), (match, track_total)).fetchone()[0]
+        return hits, total
+
+    # Quotes every term so user input can't inject FTS5 query syntax, and
+    # ORs them together like Elasticsearch's default multi_match
+    @staticmethod
+    def _match(query):
+        terms = re.findall(r'\w+', query)
+        if not terms:
+            return None
+        return ' OR '.join('"{}"'.format(term) for term in terms)
+
+
+# Elasticsearch when ELASTICSEARCH_URL is set, otherwise the embedded engine
+# SEARCH_BACKEND can force either one, or be set to 'none' to disable search
+def create_backend(app):
+    name = app.config.get('SEARCH_BACKEND') or \
+        ('elasticsearch' if app.elasticsearch else 'sqlite')
+    if name == 'elasticsearch':
+        return ElasticsearchBackend(app.elasticsearch)
+    if name == 'sqlite':
+        return SQLiteSearchBackend(app.config.get('SEARCH_INDEX_PATH') or
+            os.path.join(os.path.dirname(app.root_path), 'search.db'))
+    return None
+
 
 # Adds searchable object to index
-def add_to_index(index, model):
-    # If ES isn't running, continue without raising errors
-    if not current_app.elasticsearch:
+def add_to_index(index, id, payload):
+    # If search is disabled, continue without raising errors
+    if not current_app.search_queue:
+        return
+    current_app.search_queue.add(index, id, payload)
+
+
+def remove_from_index(index, id):
+    if not current_app.search_queue:
         return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    current_app.search_queue.remove(index, id)
 
 
-def remove_from_index(index, model):
-    if not current_app.elasticsearch:
+# Queues a chunk of (id, payload) pairs and waits for them to be sent,
+# keeping memory bounded to one chunk during a full reindex
+def bulk_index(index, documents):
+    if not current_app.search_queue:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    for id, payload in documents:
+        current_app.search_queue.add(index, id, payload)
+    current_app.search_queue.flush()
+
+
+def query_index(index, query, page, per_page, fields):
+    if not current_app.search_backend:
+        return [], 0
+    with timed('search'):
+        return current_app.search_backend.query(index, query, page, per_page,
+                                                fields)
 
 
-def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+# Searches fields of index, returning [(id, stored document)] hits and a
+# total that is exact up to SEARCH_TRACK_TOTAL_HITS (and always high enough
+# to tell whether there is a next page)
+def search_index(index, query, page, per_page, fields):
+    if not current_app.search_backend:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
+    track_total = max(current_app.config.get('SEARCH_TRACK_TOTAL_HITS', 1000),
+                      page * per_page + 1)
+    with timed('search'):
+        return current_app.search_backend.search(
+            index, query, page, per_page, fields, track_total)
+
+
+def index_version():
+    if not current_app.search_queue:
+        return 0
+    return current_app.search_queue.version()
+
+
+# LRU cache of search result pages, keyed by the caller (e.g. on the query,
+# page and index_version()) and expiring after SEARCH_CACHE_TTL seconds
+class SearchResultCache(object):
+    def __init__(self, app):
+        self.max_size = app.config.get('SEARCH_CACHE_SIZE', 1000)
+        self.ttl = app.config.get('SEARCH_CACHE_TTL', 60)
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._lru[key]
+                return None
+            self._lru.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._lru[key] = (time.time() + self.ttl, value)
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_size:
+                self._lru.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
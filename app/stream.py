@@ -0,0 +1,147 @@
+import json
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from app import db
+from app.models import User
+from app.recent import AuthorSnapshot, PostSnapshot
+
+
+# Bounded mailbox of one connected stream
+# A subscriber that falls more than `size` events behind is marked
+# overflowed and gets nothing more; its stream tells the client to reload
+class Subscription(object):
+    def __init__(self, authors, size):
+        self.authors = frozenset(authors)
+        self.size = size
+        self.overflowed = False
+        self._events = deque()
+        self._cond = threading.Condition()
+
+    def put(self, event):
+        with self._cond:
+            if self.overflowed:
+                return
+            if len(self._events) >= self.size:
+                self.overflowed = True
+                self._events.clear()
+            else:
+                self._events.append(event)
+            self._cond.notify()
+
+    # (events, overflowed), waiting up to timeout seconds for either
+    def get(self, timeout):
+        with self._cond:
+            if not self._events and not self.overflowed:
+                self._cond.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+            return events, self.overflowed
+
+
+# In-process pub/sub of new posts, fed by Post.after_commit and read by the
+# /stream endpoint, with subscriptions indexed by the authors they follow
+# Streams hold no database connection while idle, but each open one keeps
+# a server thread blocked waiting for posts, so STREAM_MAX_SUBSCRIBERS caps
+# them per process well below the server's thread limit
+# With REDIS_URL configured, posts are published on a Redis channel that one
+# listener thread per process subscribes to, so followers connected to any
+# worker see them
+class PostBus(object):
+    channel = 'stream:posts'
+
+    def __init__(self, app):
+        self.app = app
+        self.queue_size = app.config.get('STREAM_QUEUE_SIZE', 100)
+        self.max_subscribers = app.config.get('STREAM_MAX_SUBSCRIBERS', 100)
+        self.redis = app.redis
+        self._by_author = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._listener = None
+
+    # Returns None when the process already has max_subscribers streams
+    def subscribe(self, authors):
+        subscription = Subscription(authors, self.queue_size)
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                return None
+            self._count += 1
+            for author in subscription.authors:
+                self._by_author.setdefault(author, set()).add(subscription)
+            if self.redis is not None and self._listener is None:
+                self._listener = threading.Thread(target=self._listen,
+                                                  daemon=True)
+                self._listener.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._count -= 1
+            for author in subscription.authors:
+                subscribers = self._by_author.get(author)
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._by_author[author]
+
+    # Publishes committed posts (dicts staged by Post.after_flush)
+    def publish(self, posts):
+        if not posts:
+            return
+        events = [{'id': post['id'], 'user_id': post['user_id'],
+                   'body': post['body'],
+                   'timestamp': post['timestamp'].isoformat(),
+                   'language': post['language']} for post in posts]
+        if self.redis is not None:
+            self.redis.publish(self.channel, json.dumps(events))
+        else:
+            self.dispatch(events)
+
+    # Hands events to the subscriptions following their authors, loading
+    # the authors only when someone in this process is listening
+    def dispatch(self, events):
+        with self._lock:
+            targets = [(event, list(self._by_author.get(event['user_id'], ())))
+                       for event in events]
+        targets = [(event, subscribers) for event, subscribers in targets
+                   if subscribers]
+        if not targets:
+            return
+        authors = self._load_authors({event['user_id'] for event, _ in targets})
+        for event, subscribers in targets:
+            if event['user_id'] not in authors:
+                continue
+            event = dict(event, author=authors[event['user_id']])
+            for subscription in subscribers:
+                subscription.put(event)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.dispatch(json.loads(message['data']))
+            except Exception:
+                self.app.logger.exception('Post stream listener failed')
+                time.sleep(1)
+
+    def _load_authors(self, ids):
+        user = User.__table__
+        with db.get_engine(self.app).connect() as conn:
+            rows = conn.execute(db.select([
+                user.c.id, user.c.username, user.c.email, user.c.revision]).where(
+                    user.c.id.in_(ids))).fetchall()
+        return {row.id: dict(row) for row in rows}
+
+
+# Stand-in for the post an event describes, for render_post
+def snapshot(event):
+    return PostSnapshot(
+        id=event['id'], body=event['body'],
+        timestamp=datetime.fromisoformat(event['timestamp']),
+        language=event['language'], user_id=event['user_id'],
+        author=AuthorSnapshot(**event['author']))
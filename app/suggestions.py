@@ -0,0 +1,90 @@
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+
+from app import db
+from app.graph import FollowGraph
+from app.models import User, suggestion
+
+# Adjacency for worker processes, set by _init_worker
+_graph = None
+
+
+# Top-k (suggested id, score, mutual) for one user, from rows of sparse
+# products of the follow matrix A (A[u, v] = 1 when u follows v), computed
+# row by row over the CSR arrays:
+# - friends of friends: row u of A.A, i.e. how many of u's followed users
+#   follow each candidate (also reported as mutual)
+# - co-follow: users whose followed sets overlap u's most (cosine over rows
+#   of A, via row u of A.A^T) vote for what they follow, weighted by their
+#   similarity; accounts with more than max_degree followers are left out
+#   of the overlap, as they say little about shared taste and cost the most
+# Users already followed, and u itself, are never suggested
+def suggest(followed, followers, user_id, top_k=10, max_degree=1000,
+            neighbors=50, cofollow_weight=1.0):
+    own = followed.neighbors(user_id)
+    if not own:
+        return []
+    mutual = {}
+    for f in own:
+        for candidate in followed.neighbors(f):
+            mutual[candidate] = mutual.get(candidate, 0) + 1
+    overlap = {}
+    for f in own:
+        if followers.degree(f) > max_degree:
+            continue
+        for v in followers.neighbors(f):
+            overlap[v] = overlap.get(v, 0) + 1
+    overlap.pop(user_id, None)
+    norm = len(own) ** 0.5
+    similar = heapq.nlargest(neighbors, (
+        (count / (norm * followed.degree(v) ** 0.5), v)
+        for v, count in overlap.items()))
+    cofollow = {}
+    for similarity, v in similar:
+        for candidate in followed.neighbors(v):
+            cofollow[candidate] = cofollow.get(candidate, 0.0) + similarity
+    excluded = set(own)
+    excluded.add(user_id)
+    scores = ((mutual.get(c, 0) + cofollow_weight * cofollow.get(c, 0.0), c)
+              for c in set(mutual).union(cofollow) if c not in excluded)
+    return [(c, round(score, 6), mutual.get(c, 0))
+            for score, c in heapq.nlargest(top_k, scores)]
+
+
+def _init_worker(followed, followers, options):
+    global _graph
+    _graph = (followed, followers, options)
+
+
+def _suggest_range(bounds):
+    followed, followers, options = _graph
+    start, stop = bounds
+    return bounds, [
+        {'user_id': user_id, 'suggested_id': suggested_id, 'score': score,
+         'mutual': mutual}
+        for user_id in range(start, stop)
+        for suggested_id, score, mutual in suggest(
+            followed, followers, user_id, **options)]
+
+
+# Recomputes every user's suggestions from a fresh load of the follow graph
+# Workers get the graph once, when the pool starts, and score ranges of
+# chunk_size user ids; each range's rows replace its previous ones in one
+# transaction, so pages keep showing the old suggestions until then
+def compute_suggestions(app, workers=None, chunk_size=1000, **options):
+    followed, followers = FollowGraph.load(app)
+    max_id = db.session.query(db.func.max(User.id)).scalar() or 0
+    db.session.commit()
+    ranges = [(start, min(start + chunk_size, max_id + 1))
+              for start in range(1, max_id + 1, chunk_size)]
+    written = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(followed, followers, options)) as pool:
+        for (start, stop), rows in pool.map(_suggest_range, ranges):
+            with db.engine.begin() as conn:
+                conn.execute(suggestion.delete().where(db.and_(
+                    suggestion.c.user_id >= start, suggestion.c.user_id < stop)))
+                if rows:
+                    conn.execute(suggestion.insert(), rows)
+            written += len(rows)
+    return written
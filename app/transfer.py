@@ -0,0 +1,194 @@
+import csv
+import itertools
+import json
+import os
+from datetime import datetime
+
+from flask import current_app
+
+from app import db
+from app.models import Post, User, bump_content_version, followers, \
+    recompute_counters, timeline, timeline_built
+from app.search import bulk_index
+
+# Tables moved by export/import, in an order that satisfies foreign keys
+TABLES = [User.__table__, followers, Post.__table__]
+FORMATS = ('ndjson', 'csv')
+# Ids per IN list, within SQLite's bound parameter limit
+IN_BATCH = 500
+
+
+def _path(directory, table, fmt):
+    return os.path.join(directory, '{}.{}'.format(table.name, fmt))
+
+
+def _dump(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+# Column value from a file; CSV can't tell an empty string from a missing
+# value, so both read back as None
+def _load(column, value):
+    if value is None or value == '':
+        return None
+    python_type = column.type.python_type
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    if python_type in (int, float):
+        return python_type(value)
+    return value
+
+
+# Streams every row of table in primary key order with a server-side cursor,
+# chunk_size rows at a time
+def _rows(conn, table, chunk_size):
+    result = conn.execution_options(stream_results=True).execute(
+        table.select().order_by(*table.primary_key.columns))
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def _records(path, fmt, table):
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            records = csv.DictReader(f)
+        else:
+            records = (json.loads(line) for line in f if line.strip())
+        for record in records:
+            yield {column.name: _load(column, record.get(column.name))
+                   for column in table.columns}
+
+
+# Writes users, follow edges and posts to <table>.<format> files in
+# directory, as newline-delimited JSON objects or CSV with a header row
+# All tables are read in one transaction, so the files are consistent with
+# each other; memory is bounded by chunk_size rows
+def export_data(directory, fmt='ndjson', chunk_size=10000):
+    os.makedirs(directory, exist_ok=True)
+    counts = {}
+    with db.engine.connect() as conn, conn.begin():
+        for table in TABLES:
+            names = [column.name for column in table.columns]
+            count = 0
+            with open(_path(directory, table, fmt), 'w', newline='',
+                      encoding='utf-8') as f:
+                if fmt == 'csv':
+                    writer = csv.writer(f)
+                    writer.writerow(names)
+                for row in _rows(conn, table, chunk_size):
+                    values = [_dump(value) for value in row]
+                    if fmt == 'csv':
+                        writer.writerow(values)
+                    else:
+                        f.write(json.dumps(dict(zip(names, values))) + '\n')
+                    count += 1
+            counts[table.name] = count
+    return counts
+
+
+# Loads files written by export_data (tables without a file are skipped) in
+# one transaction of Core executemany batches of chunk_size rows: no ORM
+# objects are built and no session hooks run, so nothing is fanned out,
+# indexed or cached per row
+# Afterwards counters are recomputed, the timelines the import changed
+# dropped (they are rebuilt from the source tables on next read), caches
+# holding the old data cleared and the imported posts reindexed in one bulk
+# pass
+def import_data(directory, fmt='ndjson', chunk_size=10000):
+    counts = {}
+    touched = set()
+    # Users whose timelines gain imported edges, and authors of imported posts
+    edge_followers, authors = set(), set()
+    post_ids = None
+    with db.engine.begin() as conn:
+        for table in TABLES:
+            path = _path(directory, table, fmt)
+            if not os.path.exists(path):
+                continue
+            records = _records(path, fmt, table)
+            count = 0
+            while True:
+                batch = list(itertools.islice(records, chunk_size))
+                if not batch:
+                    break
+                conn.execute(table.insert(), batch)
+                count += len(batch)
+                if table is User.__table__:
+                    touched.update(record['id'] for record in batch)
+                elif table is followers:
+                    ids = [record['follower_id'] for record in batch]
+                    edge_followers.update(ids)
+                    touched.update(ids)
+                    touched.update(record['followed_id'] for record in batch)
+                else:
+                    authors.update(record['user_id'] for record in batch)
+                    touched.update(record['user_id'] for record in batch)
+                    ids = [record['id'] for record in batch]
+                    low, high = min(ids), max(ids)
+                    if post_ids is not None:
+                        low = min(low, post_ids[0])
+                        high = max(high, post_ids[1])
+                    post_ids = (low, high)
+            counts[table.name] = count
+        reset_sequences(conn)
+        bump_content_version(conn)
+
+    recompute_counters()
+    db.session.commit()
+    _drop_timelines(edge_followers, authors)
+    current_app.user_cache.invalidate(touched)
+    current_app.follow_graph.clear()
+    current_app.recent_posts.clear()
+    current_app.search_cache.clear()
+    if post_ids is not None:
+        reindex_posts(post_ids[0], post_ids[1], chunk_size)
+    return counts
+
+
+# Drops the timelines of edge_followers, of authors and of their followers,
+# IN_BATCH users per statement
+def _drop_timelines(edge_followers, authors):
+    def drop(conn, user_ids):
+        for table in (timeline_built, timeline):
+            conn.execute(table.delete().where(table.c.user_id.in_(user_ids)))
+
+    with db.engine.begin() as conn:
+        users = sorted(edge_followers | authors)
+        for i in range(0, len(users), IN_BATCH):
+            drop(conn, users[i:i + IN_BATCH])
+        authors = sorted(authors)
+        for i in range(0, len(authors), IN_BATCH):
+            drop(conn, db.select([followers.c.follower_id]).where(
+                followers.c.followed_id.in_(authors[i:i + IN_BATCH])))
+
+
+# PostgreSQL sequences don't see explicit ids, so move them past the
+# imported (or seeded) ones
+def reset_sequences(conn):
+    if conn.dialect.name != 'postgresql':
+        return
+    for table in (User.__table__, Post.__table__):
+        name = conn.dialect.identifier_preparer.quote(table.name)
+        conn.execute(db.text(
+            "SELECT setval(pg_get_serial_sequence(:name, 'id'), "
+            "coalesce(max(id), 1)) FROM {}".format(name)), name=name)
+
+
+# Sends the documents of posts from first_id to last_id written with Core
+# (which skips the indexing hooks) to the search index in chunk_size bulk
+# passes
+def reindex_posts(first_id, last_id, chunk_size):
+    done_id = first_id - 1
+    while True:
+        with db.engine.connect() as conn:
+            chunk = Post.documents(conn, db.and_(
+                Post.id > done_id, Post.id <= last_id), chunk_size)
+        if not chunk:
+            return
+        bulk_index(Post.__tablename__, chunk)
+        done_id = chunk[-1][0]
@@ -0,0 +1,363 @@
+import base64
+import heapq
+import json
+import os
+import re
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta
+from hashlib import blake2b
+
+from app import db
+
+STOPWORDS = {
+    'en': set('''a about after all also an and any are as at be because been
+        but by can could did do does for from get got had has have he her him
+        his how i if in into is it its just like me more my no not now of on
+        one only or our out she so some than that the their them then there
+        these they this to too up us was we were what when which who why will
+        with would you your'''.split()),
+    'es': set('''a al algo como con de del el ella ellos en es esta este esto
+        fue ha hay la las le lo los mas me mi muy no nos o para pero por que
+        se si sin sobre su sus te tu un una uno y ya yo'''.split()),
+}
+
+HASHTAG = re.compile(r'#(\w+)')
+WORD = re.compile(r'[^\W\d_]+')
+# Scripts written without spaces between words
+UNSPACED = re.compile('[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff]+')
+UNSPACED_LANGUAGES = ('zh', 'ja')
+
+
+# Distinct terms of a post body: #hashtags, plus words (character bigrams
+# for Chinese and Japanese) without the language's stopwords
+def tokenize(body, language=None):
+    body = (body or '').lower()
+    terms = {'#' + tag for tag in HASHTAG.findall(body)}
+    text = HASHTAG.sub(' ', body)
+    base = (language or '').split('-')[0]
+    if base in UNSPACED_LANGUAGES:
+        for run in UNSPACED.findall(text):
+            terms.update(run[i:i + 2] for i in range(max(1, len(run) - 1)))
+        text = UNSPACED.sub(' ', text)
+    stopwords = STOPWORDS.get(base, ())
+    terms.update(word for word in WORD.findall(text)
+                 if len(word) > 2 and word not in stopwords)
+    return terms
+
+
+# Count-min sketch of exponentially decayed term counts, with a heap of the
+# heaviest terms
+# Decay is applied forward: a term seen at time t adds 2^((t - t0)/half_life)
+# instead of every counter shrinking as time passes, so updates stay
+# O(depth) and relative order never changes with time alone; counts are
+# rescaled to a new t0 when the weights grow large
+class DecayedSketch(object):
+    def __init__(self, width=4096, depth=4, candidates=200, half_life=3600.0,
+                 now=None):
+        self.width = width
+        self.depth = depth
+        self.max_candidates = candidates
+        self.half_life = half_life
+        self.t0 = time.time() if now is None else now
+        self.counters = array('d', bytes(8 * width * depth))
+        self.candidates = {}
+        self._heap = []
+
+    def _cells(self, term):
+        digest = blake2b(term.encode('utf-8'), digest_size=4 * self.depth).digest()
+        return [row * self.width +
+                int.from_bytes(digest[4 * row:4 * row + 4], 'little') % self.width
+                for row in range(self.depth)]
+
+    def add(self, terms, now=None):
+        now = time.time() if now is None else now
+        exponent = (now - self.t0) / self.half_life
+        if exponent > 32:
+            self._rescale(now)
+            exponent = 0.0
+        weight = 2.0 ** exponent
+        counters = self.counters
+        for term in terms:
+            cells = self._cells(term)
+            for cell in cells:
+                counters[cell] += weight
+            estimate = min(counters[cell] for cell in cells)
+            self._offer(term, estimate)
+
+    # Decayed count estimate at now (never below the true count)
+    def estimate(self, term, now=None):
+        return min(self.counters[cell] for cell in self._cells(term)) * \
+            self.decay(now)
+
+    # [(term, decayed count)] for the n heaviest terms
+    def top(self, n, now=None):
+        decay = self.decay(now)
+        return [(term, count * decay) for term, count in heapq.nlargest(
+            n, self.candidates.items(), key=lambda item: (item[1], item[0]))]
+
+    # Factor turning stored counts into counts decayed to now
+    def decay(self, now=None):
+        now = time.time() if now is None else now
+        return 2.0 ** (-(now - self.t0) / self.half_life)
+
+    # Keeps the max_candidates heaviest terms; the heap holds (count, term)
+    # entries, stale ones being skipped when they reach the top
+    def _offer(self, term, estimate):
+        candidates = self.candidates
+        if term in candidates or len(candidates) < self.max_candidates:
+            candidates[term] = estimate
+            heapq.heappush(self._heap, (estimate, term))
+        else:
+            floor, lightest = self._lightest()
+            if estimate <= floor:
+                return
+            del candidates[lightest]
+            heapq.heappop(self._heap)
+            candidates[term] = estimate
+            heapq.heappush(self._heap, (estimate, term))
+        if len(self._heap) > 4 * self.max_candidates:
+            self._heap = [(count, term) for term, count in candidates.items()]
+            heapq.heapify(self._heap)
+
+    def _lightest(self):
+        heap = self._heap
+        while heap[0][0] != self.candidates.get(heap[0][1]):
+            heapq.heappop(heap)
+        return heap[0]
+
+    def _rescale(self, now):
+        factor = 2.0 ** (-(now - self.t0) / self.half_life)
+        counters = self.counters
+        for i in range(len(counters)):
+            counters[i] *= factor
+        self.candidates = {term: count * factor
+                           for term, count in self.candidates.items()}
+        self._heap = [(count, term) for term, count in self.candidates.items()]
+        heapq.heapify(self._heap)
+        self.t0 = now
+
+    def to_json(self):
+        return json.dumps({
+            'width': self.width, 'depth': self.depth,
+            'half_life': self.half_life, 't0': self.t0,
+            'counters': base64.b64encode(self.counters.tobytes()).decode('ascii'),
+            'candidates': self.candidates})
+
+    # Restores a snapshot taken with the same dimensions and half-life
+    def load_json(self, raw):
+        data = json.loads(raw)
+        if (data['width'], data['depth'], data['half_life']) != \
+                (self.width, self.depth, self.half_life):
+            return False
+        self.t0 = data['t0']
+        self.counters = array('d')
+        self.counters.frombytes(base64.b64decode(data['counters']))
+        self.candidates = {}
+        self._heap = []
+        for term, count in data['candidates'].items():
+            self._offer(term, count)
+        return True
+
+
+# Trending terms and hashtags over recent posts, for the explore panel
+# Fed from the post-creation commit path (Post.submit_languages, or the
+# language detector once it knows the language), so nothing is counted per
+# request; memory is fixed by TRENDING_SKETCH_WIDTH x TRENDING_SKETCH_DEPTH
+# counters plus TRENDING_CANDIDATES heavy terms, and counts halve every
+# TRENDING_HALF_LIFE seconds
+# Snapshots go to TRENDING_SNAPSHOT_PATH every TRENDING_SNAPSHOT_INTERVAL
+# seconds and at exit, and are read back at startup
+# With REDIS_URL configured, each process publishes the terms of the posts
+# it commits to the others, so every process counts all posts
+# Without it a process would only count its own posts, so once the app
+# serves requests the sketch is instead rebuilt from the posts of the last
+# TRENDING_REBUILD_WINDOW seconds at every multiple of
+# TRENDING_REBUILD_INTERVAL seconds, with counts reported as of that
+# boundary: every process shows the same panel (and explore validators), and
+# whichever process writes the snapshot last, it holds every post's counts
+# A TRENDING_REBUILD_INTERVAL of 0 counts committed posts in process instead,
+# which only suits single-process deployments
+class Trending(object):
+    channel = 'trending:terms'
+
+    def __init__(self, app):
+        self.app = app
+        self.sketch = DecayedSketch(
+            width=app.config.get('TRENDING_SKETCH_WIDTH', 4096),
+            depth=app.config.get('TRENDING_SKETCH_DEPTH', 4),
+            candidates=app.config.get('TRENDING_CANDIDATES', 200),
+            half_life=app.config.get('TRENDING_HALF_LIFE', 3600.0))
+        self.min_count = app.config.get('TRENDING_MIN_COUNT', 1.5)
+        self.snapshot_path = app.config.get('TRENDING_SNAPSHOT_PATH')
+        self.snapshot_interval = app.config.get('TRENDING_SNAPSHOT_INTERVAL', 60)
+        self.rebuild_interval = app.config.get('TRENDING_REBUILD_INTERVAL', 60)
+        self.rebuild_window = app.config.get('TRENDING_REBUILD_WINDOW',
+                                             4 * self.sketch.half_life)
+        self.rebuild_limit = app.config.get('TRENDING_REBUILD_LIMIT', 50000)
+        self.redis = app.redis
+        self._source = os.urandom(8).hex()
+        self._top = None
+        # Boundary the rebuilt sketch's counts are reported at, if any
+        self._as_of = None
+        self._started = False
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._closed = threading.Event()
+        self._restore()
+        if self.snapshot_path and self.snapshot_interval:
+            threading.Thread(target=self._snapshot_periodically,
+                             daemon=True).start()
+        if self.redis is not None:
+            threading.Thread(target=self._listen, daemon=True).start()
+
+    # Starts the periodic rebuilds of a process without Redis
+    def start(self):
+        with self._lock:
+            if self._started or self.redis is not None or \
+                    not self.rebuild_interval:
+                return
+            self._started = True
+        threading.Thread(target=self._rebuild_periodically, daemon=True).start()
+
+    # Counts the terms of committed posts (dicts with body and language);
+    # rebuilt sketches pick them up at the next boundary instead
+    def add(self, posts):
+        if self.redis is None and self.rebuild_interval:
+            return
+        batch = [sorted(tokenize(post['body'], post['language']))
+                 for post in posts]
+        batch = [terms for terms in batch if terms]
+        if not batch:
+            return
+        self._add(batch)
+        if self.redis is not None:
+            self.redis.publish(self.channel, json.dumps(
+                {'source': self._source, 'terms': batch}))
+
+    def _add(self, batch):
+        with self._lock:
+            for terms in batch:
+                self.sketch.add(terms)
+            self._top = None
+            self._dirty = True
+
+    # [(term, decayed count)] for the n heaviest terms whose count is at
+    # least min_count (the default, 1.5, takes two posts within about half
+    # of TRENDING_HALF_LIFE); the ranking is cached until the next post, only
+    # the decay is applied per call
+    def top(self, n=10):
+        with self._lock:
+            if self._top is None:
+                self._top = self.sketch.top(self.sketch.max_candidates,
+                                            now=self.sketch.t0)
+            ranking, decay = self._top, self.sketch.decay(self._as_of)
+        return [(term, count * decay) for term, count in ranking
+                if count * decay >= self.min_count][:n]
+
+    def clear(self):
+        with self._lock:
+            sketch = self.sketch
+            self.sketch = DecayedSketch(sketch.width, sketch.depth,
+                                        sketch.max_candidates, sketch.half_life)
+            self._top = None
+            self._as_of = None
+            self._dirty = True
+
+    # Replaces the sketch with one counting the posts timestamped in the
+    # window before boundary (by default the last multiple of
+    # TRENDING_REBUILD_INTERVAL), read from the primary in a fixed order so
+    # that every process builds the same one
+    def rebuild(self, boundary=None):
+        if boundary is None:
+            boundary = time.time() // self.rebuild_interval * self.rebuild_interval
+        # Imported here because app.models imports from the app package
+        from app.models import Post
+        post = Post.__table__
+        epoch = datetime(1970, 1, 1)
+        with db.get_engine(self.app).connect() as conn:
+            rows = conn.execute(db.select([
+                post.c.body, post.c.language, post.c.timestamp]).where(db.and_(
+                    post.c.timestamp >= epoch + timedelta(
+                        seconds=boundary - self.rebuild_window),
+                    post.c.timestamp < epoch + timedelta(seconds=boundary),
+                    post.c.language.isnot(None))).order_by(
+                post.c.timestamp.desc(), post.c.id.desc()).limit(
+                    self.rebuild_limit)).fetchall()
+        old = self.sketch
+        sketch = DecayedSketch(old.width, old.depth, old.max_candidates,
+                               old.half_life, now=boundary)
+        for row in reversed(rows):
+            terms = tokenize(row.body, row.language)
+            if terms:
+                sketch.add(sorted(terms),
+                           now=(row.timestamp - epoch).total_seconds())
+        with self._lock:
+            self.sketch = sketch
+            self._top = None
+            self._as_of = boundary
+            self._dirty = True
+
+    def snapshot(self):
+        if not self.snapshot_path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            raw = self.sketch.to_json()
+            self._dirty = False
+        tmp = '{}.{}.tmp'.format(self.snapshot_path, self._source)
+        with open(tmp, 'w') as f:
+            f.write(raw)
+        os.replace(tmp, self.snapshot_path)
+
+    def close(self):
+        self._closed.set()
+        self.snapshot()
+
+    def _restore(self):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with open(self.snapshot_path) as f:
+                restored = self.sketch.load_json(f.read())
+        except (OSError, ValueError, KeyError):
+            restored = False
+        if not restored:
+            self.app.logger.warning('Ignoring trending snapshot %s',
+                                    self.snapshot_path)
+
+    def _snapshot_periodically(self):
+        while not self._closed.wait(self.snapshot_interval):
+            try:
+                self.snapshot()
+            except Exception:
+                self.app.logger.exception('Trending snapshot failed')
+
+    # Rebuilds now and a second after every boundary, by which time posts
+    # timestamped before it have committed
+    def _rebuild_periodically(self):
+        while True:
+            try:
+                self.rebuild()
+            except Exception:
+                self.app.logger.exception('Trending rebuild failed')
+            delay = self.rebuild_interval - time.time() % self.rebuild_interval
+            if self._closed.wait(delay + 1):
+                return
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    data = json.loads(message['data'])
+                    if data['source'] != self._source:
+                        self._add(data['terms'])
+            except Exception:
+                self.app.logger.exception('Trending listener failed')
+                time.sleep(1)
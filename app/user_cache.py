@@ -0,0 +1,70 @@
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy.orm import make_transient_to_detached
+
+from app import db
+from app.models import User
+
+
+# Per-process LRU of user rows for Flask-Login's user_loader, so
+# authenticated requests don't start with a primary key query
+# Entries expire after USER_CACHE_TTL seconds and carry the version stamp
+# current when they were read; User.after_commit bumps the stamp whenever an
+# ORM commit changes the user (profile edits, password resets, renames,
+# follows), and the stamps live in Redis when REDIS_URL is set so every
+# worker process sees them
+# Loaded users are detached from the session: views that change one, or
+# walk its relationships, work on user.attached()
+class UserCache(object):
+    def __init__(self, app):
+        self.max_size = app.config.get('USER_CACHE_SIZE', 10000)
+        self.ttl = app.config.get('USER_CACHE_TTL', 30)
+        self.redis = app.redis
+        self._lru = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def load(self, id):
+        version = self._version(id)
+        values = None
+        with self._lock:
+            entry = self._lru.get(id)
+            if entry is not None and entry[0] > time.time() and \
+                    entry[1] == version:
+                self._lru.move_to_end(id)
+                values = entry[2]
+        if values is None:
+            user = User.__table__
+            row = db.session.execute(user.select().where(user.c.id == id)).first()
+            if row is None:
+                return None
+            values = dict(row)
+            with self._lock:
+                self._lru[id] = (time.time() + self.ttl, version, values)
+                self._lru.move_to_end(id)
+                while len(self._lru) > self.max_size:
+                    self._lru.popitem(last=False)
+        # A fresh instance per request, as if just loaded and then detached
+        user = User(**values)
+        make_transient_to_detached(user)
+        return user
+
+    def invalidate(self, ids):
+        if not ids:
+            return
+        with self._lock:
+            for id in ids:
+                self._lru.pop(id, None)
+                self._versions[id] = self._versions.get(id, 0) + 1
+        if self.redis is not None:
+            pipe = self.redis.pipeline()
+            for id in ids:
+                pipe.incr('user:version:{}'.format(id))
+            pipe.execute()
+
+    def _version(self, id):
+        if self.redis is not None:
+            return int(self.redis.get('user:version:{}'.format(id)) or 0)
+        return self._versions.get(id, 0)
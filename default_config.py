@@ -9,9 +9,22 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Comma separated read replica URLs, used for reads in GET requests
+    SQLALCHEMY_REPLICAS = [url for url in
+        (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',') if url]
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
-    MAIL_US_TLS = os.environ.get('MAIL_USE_TLS') is not None
+    MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['example@example.com']
+    # 'elasticsearch', 'sqlite' (embedded FTS5 index) or 'none'
+    # Unset picks Elasticsearch only when ELASTICSEARCH_URL is configured
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or None
+    # Optional Redis for caches shared between worker processes
+    REDIS_URL = os.environ.get('REDIS_URL')
+    SEARCH_INDEX_PATH = os.environ.get('SEARCH_INDEX_PATH') or \
+        os.path.join(basedir, 'search.db')
+    # Trending terms are restored from here at startup
+    TRENDING_SNAPSHOT_PATH = os.environ.get('TRENDING_SNAPSHOT_PATH') or \
+        os.path.join(basedir, 'trending.json')
@@ -0,0 +1,36 @@
+"""user counters
+
+Revision ID: 5e7a3b9f1c20
+Revises: d4c8e1f05a92
+Create Date: 2026-10-18 12:26:51.730415
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e7a3b9f1c20'
+down_revision = 'd4c8e1f05a92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('followers_count', sa.Integer(), server_default='0', nullable=True))
+    op.add_column('user', sa.Column('followed_count', sa.Integer(), server_default='0', nullable=True))
+    op.add_column('user', sa.Column('posts_count', sa.Integer(), server_default='0', nullable=True))
+    # Backfill from the source tables
+    op.execute('UPDATE "user" SET '
+               'followers_count = (SELECT count(*) FROM followers '
+               'WHERE followers.followed_id = "user".id), '
+               'followed_count = (SELECT count(*) FROM followers '
+               'WHERE followers.follower_id = "user".id), '
+               'posts_count = (SELECT count(*) FROM post '
+               'WHERE post.user_id = "user".id)')
+
+
+def downgrade():
+    op.drop_column('user', 'posts_count')
+    op.drop_column('user', 'followed_count')
+    op.drop_column('user', 'followers_count')
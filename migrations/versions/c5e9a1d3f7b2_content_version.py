@@ -0,0 +1,29 @@
+"""content version
+
+Revision ID: c5e9a1d3f7b2
+Revises: b7d3f2a9c1e5
+Create Date: 2026-10-18 21:12:04.118437
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e9a1d3f7b2'
+down_revision = 'b7d3f2a9c1e5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    content_version = op.create_table('content_version',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.bulk_insert(content_version, [{'id': 1, 'version': 0}])
+
+
+def downgrade():
+    op.drop_table('content_version')
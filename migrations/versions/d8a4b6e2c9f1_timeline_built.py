@@ -0,0 +1,31 @@
+"""timeline built marker
+
+Revision ID: d8a4b6e2c9f1
+Revises: c5e9a1d3f7b2
+Create Date: 2026-10-18 21:30:46.552910
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8a4b6e2c9f1'
+down_revision = 'c5e9a1d3f7b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timeline_built',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    # Timelines holding rows were built under the old rule
+    op.execute('INSERT INTO timeline_built (user_id) '
+               'SELECT DISTINCT user_id FROM timeline')
+
+
+def downgrade():
+    op.drop_table('timeline_built')
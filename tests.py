@@ -1,13 +1,50 @@
+from concurrent.futures import ThreadPoolExecutor
+from array import array
 from datetime import datetime, timedelta
+import json
+import os
+import random
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
+from flask import template_rendered
 from app import create_app, db
-from app.models import User, Post
+from app.models import User, Post, avatar_digest, followers, \
+    recompute_counters, timeline
+from app.pagination import decode_cursor, encode_cursor, paginate_keyset
+from app.bench import percentile, run_benchmark, seed_data
+from app.email import send_email
+from app.fragments import FragmentCache
+from app.graph import Adjacency, intersect
+from app.last_seen import LastSeenBuffer
+from app.logs import LogPipeline
+from app.posts import backfill_languages, create_post, normalize, \
+    search_posts
+from app.recent import RecentPosts
+from app.search import ElasticsearchBackend, IndexingQueue, SearchBackend
+from app.suggestions import compute_suggestions
+from app.transfer import export_data, import_data
+from app.trending import DecayedSketch, tokenize
 from config import Config
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    WTF_CSRF_ENABLED = False
+    POSTS_PER_PAGE = 25
+    SEARCH_BACKEND = 'sqlite'
+    SEARCH_INDEX_PATH = ':memory:'
+    SEARCH_ASYNC = False
+    LAST_SEEN_FLUSH_INTERVAL = 0
+    LANGUAGE_DETECTION_ASYNC = False
+    TRENDING_SNAPSHOT_PATH = None
+    # Single process: committed posts are counted in process
+    TRENDING_REBUILD_INTERVAL = 0
 
 
 class UserModelCase(unittest.TestCase):
@@ -38,6 +75,27 @@ class UserModelCase(unittest.TestCase):
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
 
+    def test_avatar_follows_email_changes(self):
+        u = User(username='john', email='john@example.com')
+        first = u.avatar(45)
+        u.email = 'susan@example.com'
+        self.assertNotEqual(u.avatar(45), first)
+        self.assertTrue(u.avatar(45).endswith('s=45'))
+
+    # Avatar URLs are computed once per email, not on every render
+    def test_avatar_is_memoized(self):
+        u = User(username='john', email='john@example.com')
+        with mock.patch('app.models.avatar_digest', wraps=avatar_digest) as digest:
+            urls = {u.avatar(45) for _ in range(50)}
+            self.assertEqual(urls, {'https://www.gravatar.com/avatar/'
+                                    'd4c74594d841139328695756648b6bd6'
+                                    '?d=identicon&s=45'})
+            self.assertEqual(u.avatar(128)[-5:], 's=128')
+            self.assertEqual(digest.call_count, 1)
+            u.email = 'susan@example.com'
+            u.avatar(45)
+            self.assertEqual(digest.call_count, 2)
+
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
         u2 = User(username='susan', email='susan@example.com')
@@ -63,6 +121,153 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_follow_membership_is_cached(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        u1.follow(u2)
+        db.session.commit()
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            self.assertTrue(u1.is_following(u2))
+            self.assertFalse(u1.is_following(u3))
+            u1.follow(u3)
+            self.assertTrue(u1.is_following(u3))
+            u1.unfollow(u2)
+            self.assertFalse(u1.is_following(u2))
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute',
+                            before_cursor_execute)
+        # Membership was answered from the set loaded by the first follow()
+        self.assertFalse(any('FROM followers' in s for s in statements))
+        db.session.commit()
+        self.assertEqual(u1.followed.all(), [u3])
+
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        u1.follow(u2)
+        db.session.commit()
+        u1.follow(u3)
+        u3.follow(u2)
+        db.session.add_all([Post(body='one', author=u2),
+                            Post(body='two', author=u2)])
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u1.followers_count), (2, 0))
+        self.assertEqual((u2.followed_count, u2.followers_count), (0, 2))
+        self.assertEqual(u2.posts_count, 2)
+
+        u1.unfollow(u2)
+        db.session.delete(u2.posts.first())
+        db.session.commit()
+        self.assertEqual(u1.followed_count, 1)
+        self.assertEqual(u2.followers_count, 1)
+        self.assertEqual(u2.posts_count, 1)
+
+        # Recomputing from the source tables agrees with the running counts
+        expected = [(u.followers_count, u.followed_count, u.posts_count)
+                    for u in (u1, u2, u3)]
+        recompute_counters()
+        db.session.commit()
+        self.assertEqual([(u.followers_count, u.followed_count, u.posts_count)
+                          for u in (u1, u2, u3)], expected)
+
+    def test_follow_graph(self):
+        users = [User(username='user{}'.format(i), email='{}@example.com'.format(i))
+                 for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        u0, u1, u2, u3, u4 = users
+        graph = self.app.follow_graph
+        self.assertIsNone(graph.followed(u0.id))
+        graph.reload()
+        for follower, followed in ((u0, u1), (u0, u2), (u0, u3), (u1, u2),
+                                   (u1, u3), (u2, u4), (u3, u4)):
+            follower.follow(followed)
+        db.session.commit()
+        u0.unfollow(u3)
+        u4.follow(u0)
+        db.session.commit()
+
+        self.assertEqual(list(graph.followed(u0.id)), [u1.id, u2.id])
+        self.assertEqual(list(graph.followers(u4.id)), [u2.id, u3.id])
+        self.assertEqual(graph.followers_count(u2.id), 2)
+        self.assertTrue(graph.is_following(u4.id, u0.id))
+        self.assertEqual(u0.common_followed_ids(u1), [u2.id])
+        self.assertEqual(u0.followed_followers_ids(u4), [u2.id])
+        self.assertEqual(u0.followed_ids(), {u1.id, u2.id})
+
+        # The deltas applied after commits match a fresh load
+        followed, followers = graph.load(self.app)
+        for user in users:
+            self.assertEqual(list(followed.neighbors(user.id)),
+                             list(graph.followed(user.id)))
+            self.assertEqual(list(followers.neighbors(user.id)),
+                             list(graph.followers(user.id)))
+
+        # Graph queries fall back to SQL until the graph is loaded
+        graph._followed = graph._followers = None
+        self.assertEqual(u0.common_followed_ids(u1), [u2.id])
+        self.assertEqual(u0.followed_followers_ids(u4), [u2.id])
+
+    def test_follow_graph_compaction(self):
+        rng = random.Random(7)
+        edges = set()
+        adjacency = Adjacency.from_sorted_pairs([])
+        for _ in range(2000):
+            v, w = rng.randrange(50), rng.randrange(50)
+            if rng.random() < 0.6:
+                adjacency.add(v, w)
+                edges.add((v, w))
+            else:
+                adjacency.remove(v, w)
+                edges.discard((v, w))
+            if rng.random() < 0.01:
+                adjacency = adjacency.compacted()
+        for current in (adjacency, adjacency.compacted(),
+                        adjacency.compacted().transposed().transposed()):
+            for v in range(50):
+                expected = sorted(w for x, w in edges if x == v)
+                self.assertEqual(list(current.neighbors(v)), expected)
+                self.assertEqual(current.degree(v), len(expected))
+        self.assertEqual(intersect(array('i', [1, 3, 5]),
+                                   array('i', range(0, 100, 3))), [3])
+
+    def test_suggestions(self):
+        users = [User(username='user{}'.format(i), email='{}@example.com'.format(i))
+                 for i in range(7)]
+        db.session.add_all(users)
+        db.session.commit()
+        u0, u1, u2, u3, u4, u5, u6 = users
+        for follower, followed in ((u0, u1), (u0, u2), (u1, u3), (u2, u3),
+                                   (u2, u4), (u5, u1), (u5, u2), (u5, u6)):
+            follower.follow(followed)
+        db.session.commit()
+        written = compute_suggestions(self.app, workers=2, chunk_size=2, top_k=3)
+
+        # Followed by both of u0's followed users, then by one, then followed
+        # by u5, who follows the same accounts as u0
+        self.assertEqual(u0.suggestions(), [(u3, 2), (u4, 1), (u6, 0)])
+        self.assertEqual(written, 6)
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u0.id)
+            session['_fresh'] = True
+        response = client.get('/index')
+        self.assertIn(b'Who to follow', response.data)
+        self.assertIn(b'Followed by 2 people you follow', response.data)
+        u0.follow(u3)
+        db.session.commit()
+        self.assertEqual(u0.suggestions(limit=1), [(u4, 1)])
+
     def test_follow_posts(self):
         # Create four users
         u1 = User(username='john', email='john@example.com')
@@ -101,6 +306,1072 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline_fan_out(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        now = datetime.utcnow()
+        p1 = Post(body='post from susan', author=u2,
+            timestamp=now + timedelta(seconds=1))
+        db.session.add(p1)
+        u1.follow(u2)
+        db.session.commit()
+
+        # First read builds the timeline from the source tables
+        self.assertFalse(u1.has_timeline())
+        self.assertEqual(u1.followed_posts().all(), [p1])
+        self.assertTrue(u1.has_timeline())
+
+        # New posts are pushed into existing timelines on flush
+        p2 = Post(body='another from susan', author=u2,
+            timestamp=now + timedelta(seconds=2))
+        p3 = Post(body='post from john', author=u1,
+            timestamp=now + timedelta(seconds=3))
+        db.session.add_all([p2, p3])
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [p3, p2, p1])
+
+        # Unfollowing drops the followed user's posts from the timeline
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [p3])
+
+        # Following again backfills them
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [p3, p2, p1])
+
+        # Deleted posts leave the timelines they were pushed into
+        db.session.delete(p2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [p3, p1])
+        self.assertEqual(db.session.query(timeline).filter(
+            timeline.c.post_id == p2.id).count(), 0)
+
+        # An empty timeline is built once, and reading it never commits
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add(u3)
+        db.session.commit()
+        self.assertEqual(u3.followed_posts().all(), [])
+        commits, statements = [], []
+
+        def after_commit(session):
+            commits.append(session)
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        db.event.listen(db.session, 'after_commit', after_commit)
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            self.assertEqual(u3.followed_posts().all(), [])
+        finally:
+            db.event.remove(db.session, 'after_commit', after_commit)
+            db.event.remove(db.engine, 'before_cursor_execute',
+                            before_cursor_execute)
+        self.assertEqual(commits, [])
+        self.assertFalse(any(s.startswith(('INSERT', 'DELETE')) for s in statements))
+
+    def test_keyset_pagination(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.utcnow()
+        # Two posts share a timestamp so the id tie-breaker is exercised
+        posts = [Post(body='post {}'.format(i), author=u,
+                      timestamp=now + timedelta(seconds=i // 2))
+                 for i in range(7)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        expected = Post.query.order_by(
+            Post.timestamp.desc(), Post.id.desc()).all()
+
+        page1 = paginate_keyset(Post.query, Post.timestamp, Post.id, None, 3)
+        self.assertEqual(page1.items, expected[:3])
+        self.assertFalse(page1.has_prev)
+        page2 = paginate_keyset(Post.query, Post.timestamp, Post.id,
+                                page1.next_cursor, 3)
+        self.assertEqual(page2.items, expected[3:6])
+        page3 = paginate_keyset(Post.query, Post.timestamp, Post.id,
+                                page2.next_cursor, 3)
+        self.assertEqual(page3.items, expected[6:])
+        self.assertFalse(page3.has_next)
+
+        # Walking back reproduces the earlier pages
+        back = paginate_keyset(Post.query, Post.timestamp, Post.id,
+                               page3.prev_cursor, 3)
+        self.assertEqual(back.items, expected[3:6])
+        back = paginate_keyset(Post.query, Post.timestamp, Post.id,
+                               back.prev_cursor, 3)
+        self.assertEqual(back.items, expected[:3])
+        self.assertFalse(back.has_prev)
+
+    def test_local_search(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the quick brown fox', author=u)
+        p2 = Post(body='a lazy dog and a lazy fox', author=u)
+        p3 = Post(body='nothing to see here', author=u)
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+
+        posts, total = Post.search('lazy fox', 1, 10)
+        self.assertEqual(total, 2)
+        # BM25 ranks the post matching both terms (twice) first
+        self.assertEqual(posts.all(), [p2, p1])
+
+        # Updates and deletes are applied incrementally
+        p1.body = 'the quick brown cat'
+        db.session.delete(p2)
+        db.session.commit()
+        posts, total = Post.search('fox', 1, 10)
+        self.assertEqual(total, 0)
+        posts, total = Post.search('cat OR "', 1, 10)
+        self.assertEqual(posts.all(), [p1])
+
+    def test_search_from_stored_fields(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u] + [Post(body='fox number {}'.format(i), author=u)
+                                  for i in range(5)])
+        db.session.commit()
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            posts, total = search_posts('fox', 1, 10)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute',
+                            before_cursor_execute)
+        self.assertEqual(statements, [])
+        self.assertEqual(total, 5)
+        self.assertEqual({p.author.username for p in posts}, {'john'})
+        self.assertEqual(posts[0].timestamp, Post.query.get(posts[0].id).timestamp)
+        self.assertEqual(posts[0].author.avatar(45), u.avatar(45))
+        # Documents carry the avatar digest, and emails aren't searchable
+        self.assertEqual(search_posts('example', 1, 10), ([], 0))
+        self.assertNotIn('john@example.com', json.dumps(
+            Post.query.first().search_document()))
+        # Popular queries are answered from the cache until the index changes
+        self.assertIs(search_posts('fox', 1, 10)[0], posts)
+
+        # Renames rewrite the stored author fields
+        u.username = 'johnny'
+        db.session.commit()
+        posts, total = search_posts('fox', 1, 10)
+        self.assertEqual({p.author.username for p in posts}, {'johnny'})
+
+        # Totals are only counted as far as needed
+        self.app.config['SEARCH_TRACK_TOTAL_HITS'] = 2
+        self.assertEqual(search_posts('fox', 1, 1)[1], 2)
+        self.assertEqual(search_posts('fox', 3, 1)[1], 4)
+
+        # Documents without stored fields are loaded from the database
+        legacy = Post.query.first()
+        self.app.search_queue.add('post', legacy.id, {'body': 'legacy fox'})
+        posts, total = search_posts('legacy', 1, 10)
+        self.assertEqual(posts, [legacy])
+
+    def test_last_seen_buffer(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.app.config['LAST_SEEN_FLUSH_INTERVAL'] = 60
+        buffer = LastSeenBuffer(self.app)
+        seen = datetime(2020, 1, 1)
+        buffer.touch(u.id, seen)
+        buffer.touch(u.id, seen + timedelta(seconds=5))
+        # Nothing is written until the buffer is flushed
+        db.session.expire_all()
+        self.assertNotEqual(u.last_seen, seen + timedelta(seconds=5))
+        buffer.flush()
+        db.session.expire_all()
+        self.assertEqual(u.last_seen, seen + timedelta(seconds=5))
+
+    def test_language_detection(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        post = create_post(
+            u, 'The quick brown fox jumps over the lazy dog and then runs away')
+        self.assertEqual(post.language, 'en')
+        self.assertEqual(normalize('Hola,   MUNDO 2020!'), 'hola mundo')
+
+        # Posts created without detection are picked up by the backfill
+        old = Post(body='Este es un mensaje escrito en español para la prueba.',
+                   author=u, language='')
+        db.session.add(old)
+        db.session.commit()
+        Post.query.filter_by(id=old.id).update({'language': None})
+        db.session.commit()
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            self.assertEqual(backfill_languages(pool, batch_size=1), 1)
+        db.session.expire_all()
+        self.assertEqual(old.language, 'es')
+
+    def test_trending_sketch(self):
+        self.assertEqual(tokenize('Loving the #Flask tutorial, loving it', 'en'),
+                         {'#flask', 'loving', 'tutorial'})
+        self.assertEqual(tokenize('東京タワー', 'ja'),
+                         {'東京', '京タ', 'タワ', 'ワー'})
+        sketch = DecayedSketch(width=64, depth=3, candidates=2, half_life=60,
+                               now=0)
+        for t in range(5):
+            sketch.add(['old'], now=t)
+        for t in range(3):
+            sketch.add(['new'], now=120)
+        sketch.add(['rare'], now=120)
+        # Five hits two half-lives ago weigh less than three now
+        self.assertEqual([term for term, _ in sketch.top(2, now=120)],
+                         ['new', 'old'])
+        self.assertAlmostEqual(sketch.estimate('new', now=180), 1.5)
+        self.assertEqual(sorted(sketch.candidates), ['new', 'old'])
+
+        restored = DecayedSketch(width=64, depth=3, candidates=2, half_life=60)
+        self.assertTrue(restored.load_json(sketch.to_json()))
+        self.assertEqual(restored.top(2, now=120), sketch.top(2, now=120))
+        self.assertFalse(DecayedSketch(width=32).load_json(sketch.to_json()))
+
+    def test_export_import(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com', about_me='')
+        db.session.add_all([u1, u2])
+        u1.follow(u2)
+        db.session.add_all([Post(body='a lazy fox', author=u2),
+                            Post(body='naïve "quoted", text\nover lines',
+                                 author=u1)])
+        db.session.commit()
+        susan_id = u2.id
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for fmt in ['ndjson', 'csv']:
+            path = os.path.join(directory, fmt)
+            self.assertEqual(export_data(path, fmt, chunk_size=1),
+                             {'user': 2, 'followers': 1, 'post': 2})
+            # Each format goes into an empty database
+            app = create_app(TestConfig)
+            # db.session is per thread, and bound to the app it was made in
+            db.session.remove()
+            with app.app_context():
+                db.create_all()
+                self.assertEqual(import_data(path, fmt, chunk_size=1),
+                                 {'user': 2, 'followers': 1, 'post': 2})
+                john = User.query.filter_by(username='john').one()
+                self.assertEqual(john.followed_count, 1)
+                self.assertEqual(john.posts_count, 1)
+                self.assertEqual(john.followed_ids(), {susan_id})
+                self.assertEqual([p.body for p in john.followed_posts()],
+                                 ['naïve "quoted", text\nover lines',
+                                  'a lazy fox'])
+                posts, total = Post.search('fox', 1, 10)
+                self.assertEqual(total, 1)
+                db.session.remove()
+                db.drop_all()
+
+    def test_import_only_touches_imported_rows(self):
+        mary = User(id=10, username='mary', email='mary@example.com')
+        tom = User(id=11, username='tom', email='tom@example.com')
+        ann = User(id=12, username='ann', email='ann@example.com')
+        db.session.add_all([mary, tom, ann])
+        tom.follow(mary)
+        ann.follow(tom)
+        db.session.add_all([Post(id=40, body='by tom', author=tom),
+                            Post(id=50, body='by mary', author=mary)])
+        db.session.commit()
+        tom.followed_posts().all()
+        ann.followed_posts().all()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'post.ndjson'), 'w') as f:
+            f.write(json.dumps({'id': 30, 'body': 'imported by mary',
+                                'timestamp': '2020-01-01T00:00:00',
+                                'user_id': 10}) + '\n')
+
+        with mock.patch('app.transfer.bulk_index') as bulk_index:
+            import_data(directory)
+        self.assertEqual([id for call in bulk_index.call_args_list
+                          for id, _ in call[0][1]], [30])
+        # Only the timelines showing mary's posts are rebuilt
+        self.assertTrue(ann.has_timeline())
+        self.assertFalse(tom.has_timeline())
+        self.assertEqual([p.body for p in tom.followed_posts()],
+                         ['by mary', 'by tom', 'imported by mary'])
+
+    def test_cursor_round_trip(self):
+        now = datetime.utcnow()
+        self.assertEqual(decode_cursor(encode_cursor(now, 42, 'prev')),
+                         (now, 42, 'prev'))
+        self.assertIsNone(decode_cursor('not-a-cursor'))
+        self.assertIsNone(decode_cursor(None))
+
+    def test_recent_posts_window_matches_sql(self):
+        self.app.config.update(RECENT_POSTS_PAGES=3, POSTS_PER_PAGE=4)
+        self.app.recent_posts = recent = RecentPosts(self.app)
+        users = [User(username='user{}'.format(i),
+                      email='user{}@example.com'.format(i)) for i in range(3)]
+        now = datetime.utcnow()
+
+        def add_posts(n, start):
+            # Timestamps repeat so the id tie-breaker is exercised
+            db.session.add_all([Post(body='post {}'.format(i), author=users[i % 3],
+                                     timestamp=now - timedelta(seconds=i // 3))
+                                for i in range(start, start + n)])
+            db.session.commit()
+
+        # Compares every page the window serves with the SQL page
+        def check():
+            served, cursor = 0, None
+            while True:
+                expected = paginate_keyset(Post.query, Post.timestamp, Post.id,
+                                           cursor, 4)
+                for page_cursor, sql_page in [
+                        (cursor, expected),
+                        (expected.prev_cursor, paginate_keyset(
+                            Post.query, Post.timestamp, Post.id,
+                            expected.prev_cursor, 4))]:
+                    page = recent.paginate(page_cursor, 4)
+                    if page is None or page_cursor is None and sql_page is not expected:
+                        continue
+                    self.assertEqual(
+                        [(p.id, p.body, p.language, p.author.username,
+                          p.author.avatar(45)) for p in page.items],
+                        [(p.id, p.body, p.language, p.author.username,
+                          p.author.avatar(45)) for p in sql_page.items])
+                    self.assertEqual((page.next_cursor, page.prev_cursor),
+                                     (sql_page.next_cursor, sql_page.prev_cursor))
+                    served += sql_page is expected
+                if not expected.has_next:
+                    return served
+                cursor = expected.next_cursor
+
+        db.session.add_all(users)
+        add_posts(5, 0)
+        # Everything fits, so every page is served
+        self.assertEqual(check(), 2)
+        self.assertIsNone(recent.paginate('not-a-cursor', 4))
+
+        # Posts committed later go through the commit hook, including one
+        # older than the window, which is left to SQL
+        add_posts(40, 5)
+        db.session.add(Post(body='old post', author=users[0],
+                            timestamp=now - timedelta(days=1)))
+        create_post(users[1], 'The quick brown fox jumps over the lazy dog')
+        db.session.commit()
+        self.assertEqual(check(), 3)
+        self.assertEqual(recent.latest(), tuple(db.session.query(
+            Post.timestamp, Post.id).order_by(Post.timestamp.desc(),
+                                              Post.id.desc()).first()))
+
+        # Author renames and post edits and deletes are picked up
+        users[0].username = 'renamed'
+        newest = Post.query.order_by(Post.timestamp.desc(), Post.id.desc())
+        newest[1].body = 'edited'
+        db.session.delete(newest[2])
+        db.session.commit()
+        self.assertGreaterEqual(check(), 2)
+        # Authors are held with their avatar digest only
+        self.assertNotIn('@example.com', recent._window.to_json())
+
+
+# Stand-in for the Elasticsearch client's bulk API
+class FakeElasticsearch(object):
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.requests = []
+
+    def bulk(self, body, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('node unavailable')
+        self.requests.append(body)
+        return {'errors': False, 'items': []}
+
+
+class IndexingQueueCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['SEARCH_ASYNC'] = True
+        self.app.config['SEARCH_RETRY_BACKOFF'] = 0
+        self.app.config['SEARCH_FLUSH_INTERVAL'] = 0
+
+    def test_batches_and_deduplicates(self):
+        self.app.elasticsearch = FakeElasticsearch()
+        queue = IndexingQueue(self.app,
+                              ElasticsearchBackend(self.app.elasticsearch))
+        queue.add('post', 1, {'body': 'first draft'})
+        queue.add('post', 1, {'body': 'final'})
+        queue.remove('post', 2)
+        self.assertTrue(queue.flush(timeout=5))
+        queue.close()
+        self.assertEqual(len(self.app.elasticsearch.requests), 1)
+        self.assertEqual(self.app.elasticsearch.requests[0], [
+            {'index': {'_index': 'post', '_id': 1}}, {'body': 'final'},
+            {'delete': {'_index': 'post', '_id': 2}}])
+
+    def test_retries_failed_batches(self):
+        self.app.elasticsearch = FakeElasticsearch(failures=2)
+        queue = IndexingQueue(self.app,
+                              ElasticsearchBackend(self.app.elasticsearch))
+        queue.add('post', 1, {'body': 'hello'})
+        self.assertTrue(queue.flush(timeout=5))
+        queue.close()
+        self.assertEqual(len(self.app.elasticsearch.requests), 1)
+
+    def test_incomplete_backends_fail_on_construction(self):
+        class BulkOnly(SearchBackend):
+            def bulk(self, changes):
+                return []
+        with self.assertRaises(TypeError):
+            BulkOnly()
+
+
+# Minimal local SMTP server that counts connections and delivered messages
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        self.connections = 0
+        self.messages = []
+        self.lock = threading.Lock()
+        socketserver.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), SMTPHandler)
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        self.reply('220 localhost ready')
+        while True:
+            line = self.rfile.readline().decode('utf-8').strip()
+            command = line.split(' ')[0].upper()
+            if not line or command == 'QUIT':
+                self.reply('221 bye')
+                return
+            if command == 'EHLO':
+                self.reply('250-localhost\r\n250 OK')
+            elif command == 'DATA':
+                self.reply('354 end with .')
+                data = []
+                while True:
+                    line = self.rfile.readline().decode('utf-8')
+                    if line in ('.\r\n', ''):
+                        break
+                    data.append(line)
+                with self.server.lock:
+                    self.server.messages.append(''.join(data))
+                self.reply('250 queued')
+            else:
+                self.reply('250 OK')
+
+    def reply(self, text):
+        self.wfile.write((text + '\r\n').encode('utf-8'))
+
+
+class MailQueueCase(unittest.TestCase):
+    def setUp(self):
+        self.smtp = SMTPStandIn()
+        threading.Thread(target=self.smtp.serve_forever, daemon=True).start()
+
+        class MailConfig(TestConfig):
+            MAIL_SERVER = '127.0.0.1'
+            MAIL_PORT = self.smtp.server_address[1]
+            MAIL_SUPPRESS_SEND = False
+            MAIL_WORKERS = 2
+        self.app = create_app(MailConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+        self.smtp.shutdown()
+        self.smtp.server_close()
+
+    def test_burst_reuses_connections(self):
+        for i in range(40):
+            send_email('Message {}'.format(i), sender='no-reply@example.com',
+                       recipients=['user{}@example.com'.format(i)],
+                       text_body='text', html_body='<p>html</p>')
+        self.app.mail_queue.close(timeout=10)
+        self.assertEqual(len(self.smtp.messages), 40)
+        self.assertLessEqual(self.smtp.connections, 2)
+
+
+class LogPipelineCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.smtp = SMTPStandIn()
+        threading.Thread(target=self.smtp.serve_forever, daemon=True).start()
+
+        class LogConfig(TestConfig):
+            LOG_DIR = self.tmpdir
+            MAIL_SERVER = '127.0.0.1'
+            MAIL_PORT = self.smtp.server_address[1]
+            LOG_MAIL_DELAY = 0.2
+        self.app = create_app(LogConfig)
+
+    def tearDown(self):
+        self.smtp.shutdown()
+        self.smtp.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def start(self, **config):
+        self.app.config.update(config)
+        pipeline = LogPipeline(self.app)
+        self.app.logger.setLevel('INFO')
+        self.addCleanup(self.app.logger.removeHandler, pipeline.handler)
+        return pipeline
+
+    def test_json_records_and_error_digest(self):
+        pipeline = self.start()
+        with self.app.test_request_context('/explore'):
+            self.app.logger.info('started %s', 'up')
+            for i in range(3):
+                try:
+                    raise ValueError('boom {}'.format(i))
+                except ValueError:
+                    self.app.logger.exception('failed %d', i)
+        pipeline.close()
+
+        with open(os.path.join(self.tmpdir, 'microblog.log')) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([r['message'] for r in records],
+                         ['started up', 'failed 0', 'failed 1', 'failed 2'])
+        self.assertEqual(records[1]['level'], 'ERROR')
+        self.assertEqual(records[1]['request']['path'], '/explore')
+        self.assertIn('ValueError: boom 0', records[1]['exception'])
+
+        # The burst of errors is mailed as a single digest
+        self.assertEqual(len(self.smtp.messages), 1)
+        self.assertIn('Microblog Failure: 3 errors', self.smtp.messages[0])
+        self.assertIn('ValueError: boom 2', self.smtp.messages[0])
+
+    def test_rotates_by_size(self):
+        pipeline = self.start(LOG_MAX_BYTES=1000, LOG_BACKUP_COUNT=3)
+        for i in range(50):
+            self.app.logger.info('line %d', i)
+        pipeline.close()
+        files = sorted(os.listdir(self.tmpdir))
+        self.assertEqual(len(files), 4)
+        for name in files:
+            self.assertLessEqual(
+                os.path.getsize(os.path.join(self.tmpdir, name)), 1000)
+        with open(os.path.join(self.tmpdir, 'microblog.log')) as f:
+            self.assertIn('line 49', f.read())
+
+
+# Concurrent clients need a file database; in-memory SQLite shares a single
+# connection between threads
+class BenchCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        class BenchConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+                self.tmpdir, 'bench.db')
+        self.app = create_app(BenchConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.get_engine().dispose()
+        self.app_context.pop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_bench_seed_and_run(self):
+        seed_data(users=50, posts=200, follows_per_user=5, batch_size=64,
+                  random_seed=1)
+        self.assertEqual(User.query.count(), 50)
+        self.assertEqual(Post.query.count(), 200)
+        # Popularity is skewed: the most followed account has several times
+        # the mean follower count
+        counts = [u.followers_count for u in User.query]
+        self.assertGreater(max(counts), 3 * sum(counts) / len(counts))
+        # Seeded posts are searchable, so the search route has results
+        word = Post.query.first().body.split()[0]
+        self.assertGreater(search_posts(word, 1, 10)[1], 0)
+
+        report = run_benchmark(self.app, requests=40, concurrency=2,
+                               random_seed=1)
+        self.assertEqual(report['requests'], 40)
+        for route, stats in report['routes'].items():
+            self.assertEqual(stats['errors'], 0, route)
+            self.assertLessEqual(stats['p50'], stats['p99'])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([7], 0.95), 7)
+
+
+class ReplicaCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.primary = os.path.join(self.tmpdir, 'primary.db')
+        self.replica = os.path.join(self.tmpdir, 'replica.db')
+
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + self.primary
+            SQLALCHEMY_REPLICAS = ['sqlite:///' + self.replica]
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        for bind in [None] + self.app.db_replicas:
+            db.get_engine(bind=bind).dispose()
+        self.app_context.pop()
+        shutil.rmtree(self.tmpdir)
+
+    # Stands in for replication by copying the primary's file
+    def replicate(self):
+        db.session.commit()
+        shutil.copyfile(self.primary, self.replica)
+
+    def replica_posts(self):
+        with db.get_engine(bind='replica_0').connect() as conn:
+            return [row[0] for row in conn.execute(
+                db.select([Post.body]).order_by(Post.id))]
+
+    def test_reads_use_replica_until_client_writes(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u, Post(body='old post', author=u)])
+        self.replicate()
+        db.session.add(Post(body='new post', author=u))
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+            session['_fresh'] = True
+
+        # The replica hasn't caught up with the second post
+        response = self.client.get('/user/john')
+        self.assertIn(b'old post', response.data)
+        self.assertNotIn(b'new post', response.data)
+
+        # Writes go to the primary only
+        response = self.client.post('/user/john', data={'post': 'fresh post'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.replica_posts(), ['old post'])
+        self.assertEqual(Post.query.count(), 3)
+
+        # ...and the client that wrote keeps reading from it for a while
+        response = self.client.get('/user/john')
+        self.assertIn(b'new post', response.data)
+        self.assertIn(b'fresh post', response.data)
+
+
+# Two app instances on one database file stand in for two worker processes
+# without a shared Redis
+class SharedDatabaseCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        class SharedConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+                self.tmpdir, 'app.db')
+            RECENT_POSTS_REVALIDATE = 0
+        self.apps = [create_app(SharedConfig) for _ in range(2)]
+        with self.apps[0].app_context():
+            db.create_all()
+            db.session.add_all([User(username='john', email='john@example.com'),
+                                User(username='susan', email='susan@example.com')])
+            db.session.commit()
+
+    def tearDown(self):
+        for app in self.apps:
+            with app.app_context():
+                db.session.remove()
+                db.get_engine().dispose()
+        shutil.rmtree(self.tmpdir)
+
+    # Test client of an instance, logged in as john
+    def client(self, app):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = '1'
+            session['_fresh'] = True
+        return client
+
+    def test_follows_are_seen_by_every_instance(self):
+        first, second = [self.client(app) for app in self.apps]
+        for app in self.apps:
+            app.follow_graph.reload()
+        self.assertIn(b'value="Follow"', second.get('/user/susan').data)
+        first.post('/follow/susan')
+        self.assertIn(b'value="Unfollow"', second.get('/user/susan').data)
+        second.post('/unfollow/susan')
+        self.assertIn(b'value="Follow"', first.get('/user/susan').data)
+        self.assertEqual(second.post('/follow/susan').status_code, 302)
+        with self.apps[0].app_context():
+            self.assertEqual(db.session.query(followers).count(), 1)
+
+    def test_explore_sees_posts_from_every_instance(self):
+        first, second = [self.client(app) for app in self.apps]
+        etag = second.get('/explore').headers['ETag']
+        first.post('/index', data={'post': 'posted through the first instance'})
+        response = second.get('/explore', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'posted through the first instance', response.data)
+
+    def test_trending_terms_agree_across_instances(self):
+        for app in self.apps:
+            app.trending.rebuild_interval = 60
+        with self.apps[0].app_context():
+            john = User.query.get(1)
+            for body in ['Learning #Flask templates today',
+                         'More #flask templates tonight']:
+                create_post(john, body)
+        # Committed posts wait for the next rebuild, in every instance
+        self.assertEqual(self.apps[0].trending.top(), [])
+        boundary = time.time() + 1
+        for app in self.apps:
+            app.trending.rebuild(boundary)
+        top = self.apps[0].trending.top()
+        self.assertEqual({term for term, _ in top}, {'#flask', 'templates'})
+        self.assertEqual(self.apps[1].trending.top(), top)
+
+    def test_detected_languages_reach_every_instance(self):
+        body = 'Este es un mensaje escrito en español para la prueba.'
+        with self.apps[0].app_context():
+            post_id = db.engine.execute(Post.__table__.insert().values(
+                body=body, user_id=1, timestamp=datetime.utcnow())).inserted_primary_key[0]
+        second = self.client(self.apps[1])
+        self.assertNotIn(b'Translate', second.get('/explore').data)
+        with self.apps[0].app_context():
+            self.apps[0].language_detector.submit(post_id, body)
+        self.assertIn(b'Translate', second.get('/explore').data)
+
+
+class RoutesCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, user):
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+            session['_fresh'] = True
+
+    # Counts SQL statements issued while fetching url
+    def count_queries(self, url, headers=None, status=200):
+        return len(self.capture_queries(url, headers, status))
+
+    def capture_queries(self, url, headers=None, status=200):
+        statements = []
+        # Tests share the request's session, so start from a cold one
+        db.session.expire_all()
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute',
+                        before_cursor_execute)
+        try:
+            response = self.client.get(url, headers=headers)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute',
+                            before_cursor_execute)
+        self.assertEqual(response.status_code, status)
+        return statements
+
+    def test_feed_queries_do_not_grow_with_page_size(self):
+        authors = [User(username='user{}'.format(i),
+                        email='user{}@example.com'.format(i))
+                   for i in range(10)]
+        db.session.add_all(authors)
+        db.session.add(Post(body='first post', author=authors[0]))
+        db.session.commit()
+        self.login(authors[0])
+        for url in ['/explore', '/index', '/user/user0']:
+            # Warm up once so the home timeline is already materialized
+            self.client.get(url)
+            baseline = self.count_queries(url)
+            for u in authors:
+                authors[0].follow(u)
+                db.session.add_all([Post(body='post', author=u)
+                                    for _ in range(2)])
+            db.session.commit()
+            # Following changed the logged in user, so it is reloaded once
+            self.client.get(url)
+            self.assertEqual(self.count_queries(url), baseline)
+
+    def test_recent_posts_are_preloaded(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u, Post(body='hello', author=u)])
+        db.session.commit()
+        self.app.recent_posts.revalidate_interval = 60
+        self.client.get('/auth/login')
+        self.assertIsNotNone(self.app.recent_posts._window)
+        self.login(u)
+        statements = self.capture_queries('/explore')
+        self.assertFalse(any('FROM post' in s for s in statements))
+
+    def test_server_timing_and_metrics(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u, Post(body='hello', author=u)])
+        db.session.commit()
+        self.login(u)
+        response = self.client.get('/explore')
+        timing = response.headers['Server-Timing']
+        for kind in ('db;dur=', 'tpl;dur=', 'search;dur=', 'total;dur='):
+            self.assertIn(kind, timing)
+        self.client.get('/search?q=hello')
+        self.assertIn('search;dur=', self.client.get('/search?q=hello').headers[
+            'Server-Timing'])
+
+        # Metrics need the configured token
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        self.app.config['METRICS_TOKEN'] = 'secret'
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', headers={
+            'Authorization': 'Bearer wrong'}).status_code, 401)
+        metrics = self.client.get('/metrics', headers={
+            'Authorization': 'Bearer secret'}).get_data(as_text=True)
+        self.assertIn('# TYPE microblog_request_duration_seconds histogram',
+                      metrics)
+        self.assertIn('microblog_request_duration_seconds_count'
+                      '{endpoint="main.explore"} 1', metrics)
+        self.assertIn('microblog_requests_total'
+                      '{endpoint="main.search",status="200"} 2', metrics)
+
+        # Failed statements don't leave their start time behind
+        with db.engine.connect() as conn:
+            with self.assertRaises(Exception):
+                conn.execute('SELECT * FROM missing_table')
+            self.assertEqual(conn.info['query_start'], [])
+
+    def test_post_fragments_are_cached(self):
+        u = User(username='john', email='john@example.com')
+        post = Post(body='hello', author=u)
+        db.session.add_all([u, post])
+        db.session.commit()
+        self.login(u)
+        rendered = []
+
+        def record(sender, template, context, **extra):
+            if template.name == '_post.html':
+                rendered.append(context['post'].id)
+        template_rendered.connect(record, self.app)
+        try:
+            self.client.get('/explore')
+            self.client.get('/explore')
+            self.assertEqual(rendered, [post.id])
+
+            # A username change bumps the author revision
+            u.username = 'johnny'
+            db.session.commit()
+            response = self.client.get('/explore')
+            self.assertEqual(rendered, [post.id, post.id])
+            self.assertIn(b'johnny', response.data)
+
+            # Editing the post invalidates its fragments
+            post.body = 'hello again'
+            db.session.commit()
+            response = self.client.get('/explore')
+            self.assertEqual(len(rendered), 3)
+            self.assertIn(b'hello again', response.data)
+        finally:
+            template_rendered.disconnect(record, self.app)
+
+    def test_fragment_cache_is_bounded(self):
+        cache = FragmentCache(self.app)
+        cache.max_size = 2
+        for post_id in range(5):
+            cache.set(cache.key(post_id, 'en', 0, 'en'), post_id, 'post')
+        # Evicted fragments leave the per-post index too
+        self.assertEqual(sorted(cache._keys_by_post), [3, 4])
+        self.assertEqual(cache.get(cache.key(4, 'en', 0, 'en'), 4), 'post')
+        cache.invalidate_post(4)
+        self.assertIsNone(cache.get(cache.key(4, 'en', 0, 'en'), 4))
+        self.assertEqual(sorted(cache._keys_by_post), [3])
+
+        # Local entries expire
+        cache.local_ttl = 0
+        cache.set(cache.key(5, 'en', 0, 'en'), 5, 'post')
+        self.assertIsNone(cache.get(cache.key(5, 'en', 0, 'en'), 5))
+        self.assertEqual(sorted(cache._keys_by_post), [3])
+
+    def test_conditional_get(self):
+        john = User(username='john', email='john@example.com')
+        susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([john, susan, Post(body='hello', author=susan)])
+        john.follow(susan)
+        db.session.commit()
+        self.login(john)
+        for url in ['/explore', '/index', '/user/susan']:
+            # The first visit to /index materializes the timeline
+            self.client.get(url)
+            response = self.client.get(url)
+            etag = response.headers['ETag']
+            self.assertIsNotNone(response.last_modified)
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+
+            # Unchanged pages skip the feed query and the render
+            self.assertLessEqual(self.count_queries(url, headers={
+                'If-None-Match': etag}, status=304), 4)
+
+            # A new post in scope changes the validators
+            db.session.add(Post(body='another', author=susan))
+            db.session.commit()
+            response = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+
+        # So does a profile edit
+        etag = self.client.get('/user/susan').headers['ETag']
+        susan.about_me = 'hi there'
+        db.session.commit()
+        response = self.client.get('/user/susan', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'hi there', response.data)
+
+        # Changes to what older posts render change every feed's validators
+        def rename(user):
+            user.username = 'susie'
+        for change in [rename, lambda user: db.session.delete(user.posts.first())]:
+            etags = {url: self.client.get(url).headers['ETag']
+                     for url in ['/explore', '/index']}
+            change(susan)
+            db.session.commit()
+            for url, etag in etags.items():
+                response = self.client.get(url, headers={'If-None-Match': etag})
+                self.assertEqual(response.status_code, 200)
+        self.assertIn(b'susie', response.data)
+
+    def test_explore_first_pages_come_from_memory(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.utcnow()
+        db.session.add_all([u] + [
+            Post(body='post {}'.format(i), author=u,
+                 timestamp=now - timedelta(minutes=i)) for i in range(100)])
+        db.session.commit()
+        self.login(u)
+        # The window is loaded by the first request
+        self.client.get('/explore')
+        cursor = None
+        for page in range(4):
+            url = '/explore?cursor={}'.format(cursor) if cursor else '/explore'
+            statements = self.capture_queries(url)
+            post_queries = [s for s in statements if 'FROM post' in s]
+            # Pages past RECENT_POSTS_PAGES fall back to SQL
+            self.assertEqual(bool(post_queries), page >= 3)
+            self.assertIn('post {}<'.format(page * 25).encode(),
+                          self.client.get(url).data)
+            cursor = paginate_keyset(Post.query, Post.timestamp, Post.id,
+                                     cursor, 25).next_cursor
+
+    def test_logged_in_user_is_cached(self):
+        john = User(username='john', email='john@example.com')
+        susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([john, susan])
+        db.session.commit()
+        self.login(john)
+        self.client.get('/explore')
+        user_queries = [s for s in self.capture_queries('/explore')
+                        if 'FROM user' in s]
+        self.assertEqual(user_queries, [])
+
+        # Views that change the cached user work on an attached copy, and
+        # their commits invalidate the cached entry
+        response = self.client.post('/edit_profile', data={
+            'username': 'johnny', 'about_me': 'hi'})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(b'Hi, johnny!', self.client.get('/index').data)
+        self.client.post('/follow/susan')
+        self.assertEqual(susan.followers.all(), [john])
+        self.assertIn(b'1 following', self.client.get('/user/johnny').data)
+
+        # So do changes made outside of the user's own requests
+        john.set_password('cat')
+        db.session.commit()
+        user_queries = [s for s in self.capture_queries('/explore')
+                        if 'FROM user' in s]
+        self.assertEqual(len(user_queries), 1)
+
+    def test_stream_pushes_followed_posts(self):
+        self.app.config['STREAM_HEARTBEAT'] = 0.05
+        john = User(username='john', email='john@example.com')
+        susan = User(username='susan', email='susan@example.com')
+        mary = User(username='mary', email='mary@example.com')
+        db.session.add_all([john, susan, mary])
+        john.follow(susan)
+        db.session.commit()
+        missed = Post(body='while away', author=susan)
+        db.session.add(missed)
+        db.session.commit()
+        susan_id, mary_id, missed_id = susan.id, mary.id, missed.id
+        self.login(john)
+
+        def publish():
+            with self.app.app_context():
+                for author_id, body in ((mary_id, 'not followed'),
+                                        (susan_id, 'hello followers')):
+                    db.session.add(Post(body=body, user_id=author_id))
+                    db.session.commit()
+
+        # Reconnecting after missing a post gets it before anything new
+        response = self.client.get('/stream', buffered=False, headers={
+            'Last-Event-ID': str(missed_id - 1)})
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        chunks = (chunk.decode('utf-8') for chunk in response.response)
+        self.assertIn('while away', next(chunks))
+        self.assertEqual(next(chunks), ': connected\n\n')
+        publisher = threading.Thread(target=publish)
+        publisher.start()
+        received = []
+        for chunk in chunks:
+            if chunk.startswith('id:'):
+                received.append(chunk)
+                break
+        response.close()
+        publisher.join()
+        self.assertIn('event: post', received[0])
+        self.assertIn('hello followers', received[0])
+        self.assertEqual(self.app.post_bus._by_author, {})
+
+    def test_stream_subscriptions_are_bounded(self):
+        bus = self.app.post_bus
+        bus.queue_size = 2
+        subscription = bus.subscribe([1])
+        bus.dispatch([{'id': 1, 'user_id': 2}])
+        self.assertEqual(subscription.get(0), ([], False))
+        for id in range(3):
+            subscription.put({'id': id})
+        self.assertEqual(subscription.get(0), ([], True))
+        bus.unsubscribe(subscription)
+
+    def test_explore_shows_trending_terms(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.login(u)
+        self.assertNotIn(b'Trending', self.client.get('/explore').data)
+        for body in ['Learning #Flask templates today',
+                     'More #flask templates tonight', 'Nothing in common']:
+            create_post(u, body)
+        data = self.client.get('/explore').data
+        self.assertIn(b'Trending', data)
+        self.assertIn(b'/search?q=flask">#flask</a>', data)
+        self.assertIn(b'>templates</a>', data)
+        self.assertNotIn(b'>common</a>', data)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)